@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks of the downloader against a local mock of
+class.coursera.org (see mockserver.py), so changes to the crawl and download
+paths can be measured without a network.
+
+    python bench/bench.py --weeks 10 --lectures 8 --latency 0.02 -j 4
+    python bench/bench.py --error-rate 0.1 --retries 3
+    python bench/bench.py --extract
+    python bench/bench.py --processes 4 -j 2
+
+Reports the time spent logging in, crawling and downloading a course, the
+number of requests, and the download rate in files/s and MB/s.
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+
+import reference
+from mockserver import CourseSite, MockServer
+from courseradownloader.courseradownloader import CourseraDownloader
+from courseradownloader.pool import imap_ordered
+from courseradownloader.extract import Extractor
+from courseradownloader.distributed import Coordinator, Worker
+
+COURSE = "bench-001"
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),"fixtures")
+
+# the saved pages and the extractions that apply to them
+FIXTURE_METHODS = [
+    ("lecture_index.html",("lecture_index","title")),
+    ("lecture_index_latin1.html",("lecture_index","title")),
+    ("lecture_view.html",("iframe_video","title")),
+    ("lecture_view_novideo.html",("iframe_video","title")),
+    ("home.html",("navbar_links","title")),
+    ("quiz_index.html",("item_list","title")),
+    ("assignment_index.html",("item_list","title")),
+    ("quiz_start.html",("has_quiz_start_form","has_login_form","title")),
+    ("quiz_attempt.html",("has_quiz_start_form","title")),
+    ("login.html",("has_login_form","title")),
+    ("login_failed.html",("has_login_form","title")),
+]
+
+def make_downloader(srv,**kwargs):
+    """Return a downloader that talks to the mock server"""
+    d = CourseraDownloader("bench@example.com",srv.password,True,**kwargs)
+    for name in ("HOME_URL","LECTURE_URL","LOGIN_URL","QUIZ_URL","ASSIGNMENT_URL"):
+        url = getattr(CourseraDownloader,name)
+        setattr(d,name,url.replace(CourseraDownloader.BASE_URL,srv.base_url))
+    return d
+
+def dir_size(path):
+    """Return the number and total size of the downloaded files in path"""
+    n,size = 0,0
+    for dirpath,dirnames,filenames in os.walk(path):
+        for f in filenames:
+            if not f.startswith(".coursera-dl"):
+                n += 1
+                size += os.path.getsize(os.path.join(dirpath,f))
+    return n,size
+
+def dir_digest(path):
+    """Return the sha1 of every downloaded file in path, by relative path"""
+    digest = {}
+    for dirpath,dirnames,filenames in os.walk(path):
+        for f in filenames:
+            if not f.startswith(".coursera-dl"):
+                fn = os.path.join(dirpath,f)
+                with open(fn,'rb') as fh:
+                    digest[os.path.relpath(fn,path)] = hashlib.sha1(fh.read()).hexdigest()
+    return digest
+
+def run_course(srv,dest_dir,verbose=False,stream=False,**kwargs):
+    """Download the course into dest_dir, returns a dict of measurements.
+    With stream the lectures are downloaded while they are crawled, so the
+    crawl time is part of the download time."""
+    d = make_downloader(srv,**kwargs)
+    requests = srv.requests
+    connections = srv.connections
+
+    t0 = time.time()
+    d.login(COURSE)
+    t1 = time.time()
+    jobs = d.plan_course(COURSE,dest_dir,stream=stream)
+    t2 = time.time()
+    crawl_requests = srv.requests - requests
+    crawl_connections = srv.connections - connections
+
+    failed = 0
+    try:
+        for job,out in imap_ordered(lambda j: (j,d.download_job(j)),jobs,d.workers):
+            if not job.ok:
+                failed += 1
+            if verbose:
+                for l in out: print l
+    finally:
+        d.close_manifests()
+    t3 = time.time()
+
+    files,size = dir_size(os.path.join(dest_dir,COURSE))
+    return {'login':t1 - t0,'crawl':t2 - t1,'download':t3 - t2,'total':t3 - t0,'files':files,'bytes':size,
+            'failed':failed,'requests':srv.requests - requests,'crawl_requests':crawl_requests,
+            'retried':d.controller.retried,'connections':srv.connections - connections,
+            'crawl_connections':crawl_connections}
+
+def report(name,m):
+    dl = max(m['download'],1e-6)
+    print "%-8s login %6.3fs  crawl %6.3fs (%d requests, %d connections)  download %7.3fs  total %7.3fs  %d files %.1f MB  %7.1f files/s %7.2f MB/s  %d requests, %d connections, %d retried, %d failed" % (
+        name,m['login'],m['crawl'],m['crawl_requests'],m['crawl_connections'],m['download'],m['total'],m['files'],m['bytes'] / 1048576.0,
+        m['files'] / dl,m['bytes'] / 1048576.0 / dl,m['requests'],m['connections'],m['retried'],m['failed'])
+
+def bench_download(args):
+    site = CourseSite(args.weeks,args.lectures,args.video_size * 1024,args.doc_size * 1024,
+                      args.iframe_ratio,args.quizzes,args.assignments,args.wiki)
+    srv = MockServer(site,latency=args.latency,error_rate=args.error_rate,ranges=not args.no_ranges,
+                     connect_latency=args.connect_latency).start()
+
+    print "* %d weeks x %d lectures, %d files, %.1f MB, latency %.3fs, error rate %.2f" % (
+        args.weeks,args.lectures,len(site.files()),sum(s for n,s in site.files()) / 1048576.0,
+        args.latency,args.error_rate)
+
+    kwargs = dict(workers=args.workers,crawl_workers=args.crawl_workers,per_host=args.per_host,
+                  segments=args.segments,segment_threshold=args.segment_threshold * 1024,
+                  retries=args.retries,chunk_size=args.chunk_size * 1024,keep_alive=args.keep_alive)
+    for i in range(args.runs):
+        dest_dir = tempfile.mkdtemp(prefix="coursera-bench-")
+        try:
+            report("run %d" % (i + 1),run_course(srv,dest_dir,args.verbose,args.stream,**kwargs))
+            if args.rerun:
+                # everything is there already, measures the skip path
+                report("rerun",run_course(srv,dest_dir,args.verbose,args.stream,**kwargs))
+        finally:
+            shutil.rmtree(dest_dir,ignore_errors=True)
+
+    srv.shutdown()
+
+def run_worker(srv,dest_dir,job_dir,shard,verbose,kwargs):
+    # (in a process of its own, with its own session)
+    if not verbose:
+        sys.stdout = open(os.devnull,'w')
+    Worker(make_downloader(srv,**kwargs),dest_dir,job_dir,shard).run(wait=False)
+
+def bench_distributed(args):
+    """Download the course with a coordinator and several worker processes,
+    and check the result is the same as that of a single process"""
+    site = CourseSite(args.weeks,args.lectures,args.video_size * 1024,args.doc_size * 1024,
+                      args.iframe_ratio,args.quizzes,args.assignments,args.wiki)
+    srv = MockServer(site,latency=args.latency,error_rate=args.error_rate,ranges=not args.no_ranges,
+                     connect_latency=args.connect_latency).start()
+    kwargs = dict(workers=args.workers,crawl_workers=args.crawl_workers,per_host=args.per_host,
+                  retries=args.retries,chunk_size=args.chunk_size * 1024)
+
+    single = tempfile.mkdtemp(prefix="coursera-bench-")
+    dest_dir = tempfile.mkdtemp(prefix="coursera-bench-")
+    job_dir = tempfile.mkdtemp(prefix="coursera-bench-jobs-")
+    try:
+        m = run_course(srv,single,args.verbose,**kwargs)
+        report("single",m)
+
+        t0 = time.time()
+        requests = srv.requests
+        Coordinator(make_downloader(srv,**kwargs),dest_dir,job_dir).run([COURSE])
+        t1 = time.time()
+        procs = [multiprocessing.Process(target=run_worker,args=(srv,dest_dir,job_dir,(i,args.processes) if args.shard else None,
+                                                                 args.verbose,kwargs))
+                 for i in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        t2 = time.time()
+
+        print "%-8s plan %6.3fs  %d workers %7.3fs  total %7.3fs  %d requests (%s)" % (
+            "workers",t1 - t0,args.processes,t2 - t1,t2 - t0,srv.requests - requests,"shards" if args.shard else "claims")
+
+        a,b = dir_digest(os.path.join(single,COURSE)),dir_digest(os.path.join(dest_dir,COURSE))
+        if a == b:
+            print "* identical to the single process download (%d files)" % len(a)
+        else:
+            for fn in sorted(set(a) | set(b)):
+                if a.get(fn) != b.get(fn):
+                    print "* differs: %s" % fn
+    finally:
+        for d in (single,dest_dir,job_dir):
+            shutil.rmtree(d,ignore_errors=True)
+        srv.shutdown()
+
+def check_fixtures(parsers):
+    """Check the extractions of each parser on the saved pages against the
+    BeautifulSoup code they replaced, returns the number of differences"""
+    differences = 0
+    for fn,methods in FIXTURE_METHODS:
+        with open(os.path.join(FIXTURES,fn),"rb") as f:
+            page = f.read()
+        for parser in parsers:
+            e = Extractor(parser)
+            for name in methods:
+                got = getattr(e,name)(page)
+                want = getattr(reference,name)(page,parser)
+                if got != want:
+                    differences += 1
+                    print "* %s: %s with %s differs" % (fn,name,parser)
+                    print "    got      %r" % (got,)
+                    print "    expected %r" % (want,)
+    print "* %d pages checked with %s, %d differences" % (len(FIXTURE_METHODS),", ".join(parsers),differences)
+    return differences
+
+def bench_extract(args):
+    """Compare the lecture index extraction of the available parsers, after
+    checking them on the saved pages"""
+    parsers = []
+    for parser in ("lxml","html.parser","html5lib"):
+        try:
+            reference.title("<title></title>",parser)
+            parsers.append(parser)
+        except Exception as ex:
+            print "%-12s not available (%s)" % (parser,ex)
+    if check_fixtures(parsers):
+        sys.exit(1)
+
+    page = CourseSite(args.weeks,args.lectures).lecture_index("http://localhost/%s" % COURSE)
+    print "* lecture index of %d weeks x %d lectures, %d KB" % (args.weeks,args.lectures,len(page) // 1024)
+
+    ref = None
+    for parser in parsers:
+        e = Extractor(parser)
+        t = time.time()
+        for _ in range(args.runs):
+            weeks = e.lecture_index(page)
+        t = (time.time() - t) / args.runs
+
+        ref = ref or weeks
+        print "%-12s %7.3fs %s" % (parser + (" (xpath)" if e.use_lxml else ""),t,"" if weeks == ref else "(different result)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark coursera-dl against a local mock server')
+    parser.add_argument("--weeks", dest='weeks', type=int, default=5)
+    parser.add_argument("--lectures", dest='lectures', type=int, default=6, help='lectures per week')
+    parser.add_argument("--video-size", dest='video_size', type=int, default=1024, help='size of the videos in KB')
+    parser.add_argument("--doc-size", dest='doc_size', type=int, default=64, help='size of the slides and subtitles in KB')
+    parser.add_argument("--iframe-ratio", dest='iframe_ratio', type=float, default=0.5,
+                        help='fraction of the lectures whose video is only linked from the lecture iframe')
+    parser.add_argument("--quizzes", dest='quizzes', type=int, default=2)
+    parser.add_argument("--assignments", dest='assignments', type=int, default=2)
+    parser.add_argument("--wiki", dest='wiki', type=int, default=2, help='number of wiki pages')
+    parser.add_argument("--latency", dest='latency', type=float, default=0.01, help='seconds before the server answers a request')
+    parser.add_argument("--connect-latency", dest='connect_latency', type=float, default=0,
+                        help='extra seconds before the server answers on a new connection (the TCP/TLS handshakes)')
+    parser.add_argument("--error-rate", dest='error_rate', type=float, default=0, help='fraction of the file requests that get a 503')
+    parser.add_argument("--no-ranges", dest='no_ranges', action="store_true", default=False, help='the server does not support ranges')
+    parser.add_argument("-j", dest='workers', type=int, default=CourseraDownloader.DEFAULT_WORKERS)
+    parser.add_argument("--per-host", dest='per_host', type=int, default=CourseraDownloader.DEFAULT_PER_HOST)
+    parser.add_argument("--crawl-workers", dest='crawl_workers', type=int, default=CourseraDownloader.DEFAULT_CRAWL_WORKERS)
+    parser.add_argument("--segments", dest='segments', type=int, default=CourseraDownloader.DEFAULT_SEGMENTS)
+    parser.add_argument("--segment-threshold", dest='segment_threshold', type=int, default=CourseraDownloader.DEFAULT_SEGMENT_THRESHOLD // 1024,
+                        help='in KB')
+    parser.add_argument("--chunk-size", dest='chunk_size', type=int, default=CourseraDownloader.DEFAULT_CHUNK_SIZE // 1024,
+                        help='in KB')
+    parser.add_argument("--retries", dest='retries', type=int, default=CourseraDownloader.DEFAULT_RETRIES)
+    parser.add_argument("--no-keep-alive", dest='keep_alive', action="store_false", default=True,
+                        help='open a new connection for every request')
+    parser.add_argument("--runs", dest='runs', type=int, default=3)
+    parser.add_argument("--rerun", dest='rerun', action="store_true", default=False,
+                        help='also measure a second run into the same directory')
+    parser.add_argument("--stream", dest='stream', action="store_true", default=False,
+                        help='download the lectures while the course is crawled (as coursera-dl does)')
+    parser.add_argument("--extract", dest='extract', action="store_true", default=False,
+                        help='check the html parsers on the pages in fixtures/ and compare them on the lecture index instead')
+    parser.add_argument("--processes", dest='processes', type=int, default=0,
+                        help='download with a coordinator and this many worker processes instead, and compare with a single process')
+    parser.add_argument("--shard", dest='shard', action="store_true", default=False,
+                        help='with --processes, the workers take fixed shards of the jobs rather than claiming them')
+    parser.add_argument("-v", dest='verbose', action="store_true", default=False, help='print the download output')
+    args = parser.parse_args()
+
+    if args.extract:
+        bench_extract(args)
+    elif args.processes:
+        bench_distributed(args)
+    else:
+        bench_download(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+A local stand-in for class.coursera.org serving synthetic courses with the
+markup CourseraDownloader expects (lecture index, lecture iframes, quiz and
+assignment lists, wiki pages and the login form), used by the benchmarks.
+"""
+import re
+import time
+import random
+import hashlib
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+class CourseSite(object):
+    """Synthetic course of `weeks` x `lectures` lectures, each with a pdf, a
+    subtitle file and a video. The video of a fraction iframe_ratio of the
+    lectures is only linked from the lecture iframe page. Every course name
+    gets the same site."""
+
+    def __init__(self,weeks=3,lectures=4,video_size=256*1024,doc_size=16*1024,
+                 iframe_ratio=0.5,quizzes=2,assignments=2,wiki=2):
+        self.weeks = weeks
+        self.lectures = lectures
+        self.video_size = video_size
+        self.doc_size = doc_size
+        self.iframe_ratio = iframe_ratio
+        self.quizzes = quizzes
+        self.assignments = assignments
+        self.wiki = wiki
+        self.etag = '"v1"'
+
+    # the assets loaded by the course pages
+    HEAD = ('<link rel="stylesheet" href="/static/site.css"/><link rel="alternate" href="/feed.rss"/>'
+            '<script src="/static/site.js"></script>')
+    ASSETS = {'site.css':('text/css','body { background: url(bg.png) }'),
+              'site.js':('application/javascript','var site = 1;'),
+              'bg.png':('image/png','\x89PNG bg'),'logo.png':('image/png','\x89PNG logo')}
+
+    def files(self):
+        """Return the (name,size) of all the lecture files"""
+        out = []
+        for w in range(1,self.weeks + 1):
+            for l in range(1,self.lectures + 1):
+                lid = "%d-%d" % (w,l)
+                out += [("slides-%s.pdf" % lid,self.doc_size),("subs-%s.srt" % lid,self.doc_size),
+                        ("video-%s.mp4" % lid,self.video_size)]
+        return out
+
+    def body(self,name,size):
+        """The (deterministic) contents of a file"""
+        seed = hashlib.sha1(name).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def lecture_index(self,base):
+        out = ['<html><head><title>Lectures</title></head><body><div class="course-item-list">']
+        n = 0
+        for w in range(1,self.weeks + 1):
+            out.append('<div class="course-item-list-header"><h3>Week %d: Topic %d</h3></div>' % (w,w))
+            out.append('<ul class="course-item-list-section-list">')
+            for l in range(1,self.lectures + 1):
+                n += 1
+                lid = "%d-%d" % (w,l)
+                res = ['<a href="%s/files/slides-%s.pdf">slides</a>' % (base,lid),
+                       '<a href="%s/files/subs-%s.srt">subtitles</a>' % (base,lid)]
+                if self.iframe_ratio == 0 or (n * self.iframe_ratio) % 1 >= self.iframe_ratio:
+                    res.append('<a href="%s/files/video-%s.mp4">video</a>' % (base,lid))
+                out.append('<li><a class="lecture-link" data-modal-iframe="%s/lecture/view?lecture_id=%s" href="#">'
+                           'Lecture %s: Something</a><div class="course-lecture-item-resource">%s</div></li>'
+                           % (base,lid,lid,"".join(res)))
+            out.append('</ul>')
+        out.append('</div></body></html>')
+        return "".join(out)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # (the headers are written one by one, which would otherwise stall
+    # responses on persistent connections for the delayed ack of the client)
+    disable_nagle_algorithm = True
+
+    def log_message(self,*args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        srv = self.server
+        srv.count_connection()
+        if srv.connect_latency:
+            # the handshakes of a new connection
+            time.sleep(srv.connect_latency)
+
+    def send_body(self,body,ctype="text/html",code=200,headers=()):
+        self.send_response(code)
+        self.send_header("Content-Type",ctype)
+        self.send_header("Content-Length",str(len(body)))
+        for k,v in headers:
+            self.send_header(k,v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+            self.server.count(len(body))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length",0))
+        data = urlparse.parse_qs(self.rfile.read(length))
+        srv = self.server
+        srv.count()
+        if data.get("password",[""])[0] == srv.password:
+            self.send_body('<html><head><title>Course home</title></head><body>ok</body></html>',
+                           headers=[("Set-Cookie","session=%s; Path=/" % srv.session)])
+        else:
+            self.send_body('<html><head><title>Coursera | Login Failed</title></head><body></body></html>')
+
+    def do_GET(self):
+        srv = self.server
+        srv.count()
+        if srv.latency:
+            time.sleep(srv.latency)
+
+        u = urlparse.urlparse(self.path)
+        q = urlparse.parse_qs(u.query)
+        parts = u.path.strip("/").split("/")
+        course,path = parts[0],"/".join(parts[1:])
+        site = srv.site
+        base = srv.base_url % course
+        authed = ("session=%s" % srv.session) in self.headers.get("Cookie","")
+
+        if course == "static" and path in site.ASSETS:
+            ctype,body = site.ASSETS[path]
+            return self.send_body(body,ctype)
+
+        if path == "auth/auth_redirector":
+            if authed:
+                return self.send_body('<html><head><title>Course</title></head><body></body></html>')
+            return self.send_body('<html><head><title>Login</title></head><body>'
+                                  '<form method="post" action="%s/auth/login">'
+                                  '<input type="text" name="email"/>'
+                                  '<input type="password" name="password" id="password_login"/>'
+                                  '</form></body></html>' % base)
+        if not authed:
+            return self.send_body("denied",code=403)
+
+        if srv.error_rate and path.startswith("files/") and random.random() < srv.error_rate:
+            return self.send_body("busy",code=503,headers=[("Retry-After","0")])
+
+        if path == "class/index":
+            links = "".join('<li><a href="%s/wiki/view?page=page%d">Page %d</a></li>' % (base,i,i)
+                            for i in range(site.wiki))
+            return self.send_body('<html><head><title>Home</title>%s</head><body><img src="/static/logo.png">'
+                                  '<ul class="course-navbar-list"><li><a href="%s/lecture/index">Lectures</a></li>%s</ul>'
+                                  '</body></html>' % (site.HEAD,base,links))
+        if path == "lecture/index":
+            if self.headers.get("If-None-Match") == site.etag:
+                return self.send_body("",code=304,headers=[("ETag",site.etag)])
+            return self.send_body(site.lecture_index(base),headers=[("ETag",site.etag)])
+        if path == "lecture/view":
+            lid = q["lecture_id"][0]
+            return self.send_body('<html><body><video><source type="video/mp4" src="%s/files/video-%s.mp4"/>'
+                                  '</video></body></html>' % (base,lid))
+        if path == "wiki/view":
+            return self.send_body('<html><head><title>%s</title>%s</head><body>wiki <img src=\'../../static/logo.png\'></body></html>'
+                                  % (q["page"][0],site.HEAD))
+        if path in ("quiz/index","assignment/index"):
+            n = site.quizzes if path == "quiz/index" else site.assignments
+            kind = path.split("/")[0]
+            items = "".join('<li><h4>%s %d</h4><a class="btn-primary" href="%s/%s/start?id=%d">Start</a></li>'
+                            % (kind.title(),i,base,kind,i) for i in range(1,n + 1))
+            return self.send_body('<html><body><div class="course-item-list"><ul>%s</ul></div></body></html>' % items)
+        if path in ("quiz/attempt","assignment/start"):
+            return self.send_body('<html><body>%s %s</body></html>' % (path,q.get("id")))
+        if path.startswith("files/"):
+            return self.send_file(path[len("files/"):])
+        return self.send_body("not found",code=404)
+
+    def send_file(self,name):
+        site = self.server.site
+        size = site.video_size if name.endswith(".mp4") else site.doc_size
+        body = site.body(name,size)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body("",code=304,headers=[("ETag",etag)])
+
+        headers = [("ETag",etag),("Last-Modified","Mon, 01 Oct 2012 00:00:00 GMT"),
+                   ("Content-Disposition",'attachment; filename="%s"' % name)]
+        if self.server.ranges:
+            headers.append(("Accept-Ranges","bytes"))
+
+        m = re.match(r"bytes=(\d+)-(\d*)$",self.headers.get("Range",""))
+        if m and self.server.ranges:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else size - 1
+            if start >= size:
+                return self.send_body("",code=416,headers=[("Content-Range","bytes */%d" % size)])
+            headers.append(("Content-Range","bytes %d-%d/%d" % (start,end,size)))
+            return self.send_body(body[start:end + 1],"application/octet-stream",206,headers)
+        return self.send_body(body,"application/octet-stream",headers=headers)
+
+class MockServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """Serves the site on a free local port. Requests are answered after
+    `latency` seconds (and a new connection takes connect_latency seconds
+    more), and a fraction error_rate of the file requests gets a 503. The
+    number of requests, connections and bytes served are counted."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,site,port=0,latency=0,error_rate=0,ranges=True,password="secret",connect_latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self,("127.0.0.1",port),Handler)
+        self.site = site
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.error_rate = error_rate
+        self.ranges = ranges
+        self.password = password
+        self.session = hashlib.md5(str(random.random())).hexdigest()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.bytes = 0
+
+    def count(self,nbytes=0):
+        with self.lock:
+            if nbytes:
+                self.bytes += nbytes
+            else:
+                self.requests += 1
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def handle_error(self,request,client_address):
+        # clients hanging up early (e.g. after reading the headers) are fine
+        pass
+
+    @property
+    def base_url(self):
+        """The url of a course (with a %s for the course name)"""
+        return "http://%s:%d/%%s" % self.server_address
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
@@ -0,0 +1,44 @@
+"""
+The page extraction as the downloader did it before extract.py: a full
+BeautifulSoup tree per page and the same lookups on it, returning what the
+Extractor methods return, so the two can be compared on the saved pages in
+fixtures/ (see bench.py --extract).
+"""
+from bs4 import BeautifulSoup
+
+def lecture_index(page,parser):
+    soup = BeautifulSoup(page,parser)
+    weeks = []
+    for header in soup.findAll("div", { "class" : "course-item-list-header" }):
+        h3 = header.findNext('h3')
+        lectures = []
+        for li in header.next_sibling.findAll('li'):
+            classResources = li.find('div', {'class':'course-lecture-item-resource'})
+            ll = li.find('a',{'class':'lecture-link'})
+            lectures.append((li.a.text,[h['href'] for h in classResources.findAll('a')],
+                             ll['data-modal-iframe'] if ll else None))
+        weeks.append((h3.text,lectures))
+    return weeks
+
+def iframe_video(page,parser):
+    vobj = BeautifulSoup(page,parser).find('source',type="video/mp4")
+    return vobj['src'] if vobj else None
+
+def item_list(page,parser):
+    qlist = BeautifulSoup(page,parser).find('div',{'class':'course-item-list'})
+    qurls = [q['href'] for q in qlist.findAll('a',{'class':'btn-primary'})]
+    titles = [t.string for t in qlist.find_all('h4')]
+    return zip(qurls,titles)
+
+def navbar_links(page,parser):
+    qlist = BeautifulSoup(page,parser).find('ul',{'class':'course-navbar-list'})
+    return [q['href'] for q in qlist.findAll('a')]
+
+def has_login_form(page,parser):
+    return bool(BeautifulSoup(page,parser).findAll("input",{"id":"password_login"}))
+
+def has_quiz_start_form(page,parser):
+    return bool(BeautifulSoup(page,parser).findAll("form", {"class":"course-quiz-start-form"}))
+
+def title(page,parser):
+    return BeautifulSoup(page,parser).title.string
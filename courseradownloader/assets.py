@@ -0,0 +1,108 @@
+"""
+Shared copies of the stylesheets, scripts and images of the archived pages,
+so the saved pages render offline without every page having its own copy.
+"""
+import os
+import re
+import json
+import hashlib
+import urlparse
+import threading
+from writer import write_file
+
+# the tags that load assets, and their url attributes
+TAG = re.compile(r'<(link|script|img)\b[^>]*>',re.I)
+ATTR = re.compile(r'''(\s(?:src|href)\s*=\s*)(["']?)([^"'\s>]+)\2''',re.I)
+LINK_REL = re.compile(r'''\srel\s*=\s*["']?[^"'>]*\b(stylesheet|icon)\b''',re.I)
+
+# urls referred to from stylesheets (fonts, background images)
+CSS_URL = re.compile(r'''url\(\s*(["']?)([^"')\s]+)\1\s*\)''',re.I)
+
+class AssetCache(object):
+    """Directory in the course directory holding every asset once, named by
+    the checksum of its contents (so the same file under different urls is
+    kept once too), with an index of the urls fetched so far."""
+
+    DIRNAME = "assets"
+    INDEX = "index.json"
+
+    def __init__(self,course_dir,fetch):
+        """fetch(url) returns the contents of the url"""
+        self.dir = os.path.join(course_dir,self.DIRNAME)
+        self.fetch = fetch
+
+        self.lock = threading.Lock()
+        self.index = {}
+        self.failed = set()
+        # one lock per url being fetched, so it is only fetched once
+        self.pending = {}
+
+        try:
+            with open(os.path.join(self.dir,self.INDEX)) as f:
+                self.index = json.load(f)
+        except (IOError,ValueError):
+            pass
+
+    def get(self,url,css=True):
+        """Return the file name (in the cache directory) of the asset at the
+        url, fetching it the first time, or None if it cannot be fetched.
+        The urls in stylesheets are made to point at the cache too (unless
+        css is False)."""
+        with self.lock:
+            if url in self.index or url in self.failed:
+                return self.index.get(url)
+            lock = self.pending.setdefault(url,threading.Lock())
+
+        with lock:
+            with self.lock:
+                if url in self.index or url in self.failed:
+                    return self.index.get(url)
+
+            try:
+                data = self.fetch(url)
+            except Exception:
+                with self.lock:
+                    self.failed.add(url)
+                return None
+
+            ext = os.path.splitext(urlparse.urlparse(url).path)[1].lower()
+            if css and ext == ".css":
+                # (these are in the same directory)
+                data = self.rewrite_css(data,url)
+
+            name = hashlib.sha1(data).hexdigest() + ext[:8]
+            path = os.path.join(self.dir,name)
+            if not os.path.exists(path):
+                if not os.path.exists(self.dir):
+                    os.makedirs(self.dir)
+                write_file(path,data)
+
+            with self.lock:
+                self.index[url] = name
+                write_file(os.path.join(self.dir,self.INDEX),json.dumps(self.index))
+            return name
+
+    def rewrite_css(self,css,css_url):
+        def repl(m):
+            url = urlparse.urljoin(css_url,m.group(2))
+            name = self.get(url,css=False) if url.startswith(('http:','https:')) else None
+            return 'url("%s")' % name if name else m.group(0)
+        return CSS_URL.sub(repl,css)
+
+    def localize(self,html,page_url,page_path):
+        """Return the page (saved at page_path) with the stylesheets, scripts
+        and images it loads replaced by their copies in the cache"""
+        prefix = os.path.relpath(self.dir,os.path.dirname(page_path)).replace(os.sep,'/')
+
+        def attr(m):
+            url = urlparse.urljoin(page_url,m.group(3).replace('&amp;','&'))
+            name = self.get(url) if url.startswith(('http:','https:')) else None
+            return '%s"%s/%s"' % (m.group(1),prefix,name) if name else m.group(0)
+
+        def tag(m):
+            if m.group(1).lower() == 'link' and not LINK_REL.search(m.group(0)):
+                # not an asset (e.g. a link to an rss feed)
+                return m.group(0)
+            return ATTR.sub(attr,m.group(0))
+
+        return TAG.sub(tag,html)
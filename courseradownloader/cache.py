@@ -0,0 +1,46 @@
+"""
+On disk cache of the crawled structure of a course (the weekly topics,
+lectures and their resources, and the wiki/assignment/quiz lists), so a run can
+skip scraping the course when nothing has changed.
+"""
+import os
+import json
+import time
+from writer import write_file
+
+class CrawlCache(object):
+    """JSON file in the course directory holding the structure returned by
+    CourseraDownloader.crawl_course, when it was crawled and the ETag of the
+    lecture index page it was parsed from"""
+
+    FILENAME = ".coursera-dl-crawl.json"
+
+    def __init__(self,course_dir,ttl=0):
+        """Entries younger than ttl seconds are used without revalidation"""
+        self.path = os.path.join(course_dir,self.FILENAME)
+        self.ttl = ttl
+
+    def load(self):
+        """Return the cached entry (a dict with time, etag and course), or None"""
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (IOError,ValueError):
+            return None
+
+        # json turns the (url,filename) resource tuples into lists
+        for weekClasses in entry['course']['allClasses'].values():
+            for k,v in weekClasses.items():
+                if k != 'classNames':
+                    weekClasses[k] = [tuple(x) for x in v]
+
+        return entry
+
+    def is_fresh(self,entry):
+        return entry is not None and time.time() - entry['time'] < self.ttl
+
+    def save(self,course,etag=None):
+        entry = {'time':time.time(),'etag':etag,'course':course}
+
+        # (so a crash never leaves a broken cache)
+        write_file(self.path,json.dumps(entry))
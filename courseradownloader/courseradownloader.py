@@ -2,11 +2,30 @@ import re
 import urllib
 import argparse
 import os
+import sys
 import errno
 import unicodedata
 import getpass
-from mechanize import Browser
-from bs4 import BeautifulSoup
+import threading
+import hashlib
+import itertools
+from mechanize import Browser, CookieJar, LWPCookieJar, Request, UserAgentBase, HTTPError
+from pool import imap_ordered, HostLimiter
+from manifest import Manifest, file_sha1
+from cache import CrawlCache
+from extract import Extractor
+from scheduler import Job, Scheduler
+from plan import Planner
+from distributed import Coordinator, Worker, parse_shard
+from watch import Watcher
+from store import ObjectStore
+from assets import AssetCache
+from pack import Pack
+from transport import ConnectionPool, KeepAliveHandler, KeepAliveHTTPSHandler
+from filters import Filter, resource_name, parse_weeks
+from writer import PartFile, SegmentedPart, detach, replace, write_file
+from retry import RequestController
+from metrics import Metrics, MetricsHandler, ProgressBar, timed
 
 class CourseraDownloader(object):
     """
@@ -24,44 +43,209 @@ class CourseraDownloader(object):
     ASSIGNMENT_URL = BASE_URL + '/assignment/index'
 
     DEFAULT_PARSER = "lxml"
-
-    def __init__(self,username,password, quiz, parser=DEFAULT_PARSER):
+    DEFAULT_WORKERS = 1
+    DEFAULT_PER_HOST = 4
+    DEFAULT_CRAWL_WORKERS = 4
+    DEFAULT_CACHE_TTL = 0
+    DEFAULT_SEGMENTS = 1
+    DEFAULT_SEGMENT_THRESHOLD = 32 * 1024 * 1024
+    DEFAULT_RETRIES = 5
+
+    # number of bytes read at a time when saving a download
+    DEFAULT_CHUNK_SIZE = 256 * 1024
+
+    # the orders the lecture resources can be downloaded in (see order_jobs)
+    ORDERS = ('course','newest','smallest')
+    DEFAULT_ORDER = 'course'
+
+    def __init__(self,username,password, quiz, parser=DEFAULT_PARSER, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+                 crawl_workers=DEFAULT_CRAWL_WORKERS, revalidate=False, cache_ttl=DEFAULT_CACHE_TTL,
+                 segments=DEFAULT_SEGMENTS, segment_threshold=DEFAULT_SEGMENT_THRESHOLD, retries=DEFAULT_RETRIES,
+                 cookie_file=None, store_dir=None, chunk_size=DEFAULT_CHUNK_SIZE, archive_pages=False,
+                 pack=False, pack_loose_size=None, keep_alive=True, file_filter=None, order=DEFAULT_ORDER):
         """Requires your coursera username and password. 
         You can also specify the parser to use (defaults to lxml), see http://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser
+        The number of parallel downloads and the maximum number of concurrent requests to a single host can be set with workers and per_host,
+        crawl_workers is the number of lecture pages that are fetched in parallel while collecting the downloadable content.
+        Files that were downloaded completely before are skipped, unless revalidate is set and the server reports they have changed.
+        The crawled course structure is cached for cache_ttl seconds (None disables the cache), see crawl_course.
+        Files of at least segment_threshold bytes are downloaded in the given number of segments, in parallel as far as per_host allows.
+        Failed requests are retried up to retries times, see RequestController.
+        If a cookie file is given the login session is kept there, so later runs do not need to log in again while it is valid.
+        The password is asked for when it is needed and not given.
+        With a store_dir, the downloaded files are kept once in a content addressed store shared by all courses and linked into the course directories.
+        Downloads are read and written chunk_size bytes at a time.
+        With archive_pages, the stylesheets, scripts and images of the saved pages are saved too (once per course) and the pages changed to use them.
+        With pack, the files of a course are kept in a single zip file (see Pack), except those of at least pack_loose_size bytes.
+        With keep_alive, the connections are kept open and reused for later requests to the same host (see ConnectionPool).
+        Only the lecture resources that pass the file_filter are downloaded (see Filter), in the given order (see order_jobs).
         """
         self.username = username
         self.password = password
         self.parser = parser
+        self.extract = Extractor(parser)
         self.quiz = quiz
+        self.workers = workers
+        self.crawl_workers = crawl_workers
+        self.revalidate = revalidate
+        self.cache_ttl = cache_ttl
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.chunk_size = chunk_size
+        self.archive_pages = archive_pages
+        self.pack = pack
+        self.pack_loose_size = pack_loose_size
+        self.filter = file_filter
+        self.order = order
+        self.host_limiter = HostLimiter(per_host)
+
+        # request counts and timings, by phase
+        self.metrics = Metrics()
+
+        # every request goes through here to be retried, and throttled when
+        # the server is overloaded
+        # (the segments of a download share its slots, see download_segmented)
+        self.controller = RequestController(retries,max_concurrency=max(workers,crawl_workers,segments))
+
+        # the persistent connections, shared by all browsers
+        self.pool = ConnectionPool(max(workers,crawl_workers),self.metrics.connection) if keep_alive else None
+
+        # all browsers share the same cookies (and hence the same login session)
+        self.cookie_file = cookie_file
+        if cookie_file:
+            self.cookiejar = LWPCookieJar(cookie_file)
+            if os.path.exists(cookie_file):
+                # (the session cookies are discardable, but we do want them)
+                self.cookiejar.load(ignore_discard=True)
+        else:
+            self.cookiejar = CookieJar()
+
+        # the courses for which the session was checked during this run
+        self.sessions = set()
+
+        self._local = threading.local()
+        self.browser = self.get_browser()
+
+        # the manifests of the courses being downloaded, by course directory
+        self.manifests = {}
+        self.manifests_lock = threading.Lock()
+
+        # the asset caches of the archived pages, and the packs, by course directory
+        self.asset_caches = {}
+        self.packs = {}
+
+        self.store = ObjectStore(store_dir) if store_dir else None
+
+    def new_browser(self):
+        """Return a new browser that shares the cookies of the login session"""
+        b = Browser()
+        b.set_handle_robots(False)
+        b.set_cookiejar(self.cookiejar)
+        b.add_handler(MetricsHandler(self.metrics))
+        if self.pool:
+            b.add_handler(KeepAliveHandler(self.pool))
+            b.add_handler(KeepAliveHTTPSHandler(self.pool))
+        return b
+
+    def get_browser(self):
+        """Return the browser of the calling thread (mechanize browsers are not thread safe)"""
+        b = getattr(self._local,'browser',None)
+        if b is None:
+            b = self._local.browser = self.new_browser()
+        return b
+
+    def get_manifest(self,course_dir):
+        """Return the (shared) manifest of the course directory"""
+        with self.manifests_lock:
+            if course_dir not in self.manifests:
+                self.manifests[course_dir] = Manifest(course_dir)
+            return self.manifests[course_dir]
+
+    def get_assets(self,course_dir):
+        """Return the (shared) asset cache of the course directory"""
+        with self.manifests_lock:
+            if course_dir not in self.asset_caches:
+                self.asset_caches[course_dir] = AssetCache(course_dir,self.fetch_asset)
+            return self.asset_caches[course_dir]
+
+    def get_pack(self,course_dir):
+        """Return the (shared) pack of the course directory"""
+        with self.manifests_lock:
+            if course_dir not in self.packs:
+                self.packs[course_dir] = Pack(course_dir,self.pack_loose_size)
+            return self.packs[course_dir]
+
+    def fetch_asset(self,url):
+        """Return the contents of the url"""
+        def fetch():
+            r = self.open_stream(url)
+            try:
+                return r.read()
+            finally:
+                r.close()
+
+        # (no host slot is taken, the job archiving the page already holds one)
+        return self.controller.call(fetch,url)
+
+    def close_manifests(self):
+        with self.manifests_lock:
+            for m in self.manifests.values():
+                m.close()
+            self.manifests = {}
+
+    def log(self,msg):
+        """Print a message, or buffer it if the calling thread is collecting its output"""
+        buf = getattr(self._local,'output',None)
+        if buf is None:
+            print msg
+        else:
+            buf.append(msg)
 
-        self.browser = Browser()
-        self.browser.set_handle_robots(False)
-
+    @timed('login')
     def login(self,course_name):
-        print "* Authenticating as %s..." % self.username
+        if course_name in self.sessions:
+            # checked already
+            return
+
+        self.log("* Authenticating as %s..." % self.username)
 
         # open the course login page
-        page = self.browser.open(self.LOGIN_URL % course_name)
+        page = self.open_page(self.LOGIN_URL % course_name)
 
         # check if we are already logged in by checking for a password field
-        bs = BeautifulSoup(page,self.parser)
-        pwdfield = bs.findAll("input",{"id":"password_login"})
-
-        if pwdfield:
-            self.browser.form = self.browser.forms().next()
-            self.browser['email'] = self.username
-            self.browser['password'] = self.password
-            r = self.browser.submit()
+        if self.extract.has_login_form(page):
+            if self.password is None:
+                self.password = getpass.getpass()
+
+            # (the page was opened in the browser of this thread, which may
+            # not be the main one when the courses are planned as they download)
+            browser = self.get_browser()
+            browser.form = browser.forms().next()
+            browser['email'] = self.username
+            browser['password'] = self.password
+            r = browser.submit()
 
             # check that authentication actually succeeded
-            bs2 = BeautifulSoup(r.read(),self.parser)
-            title = bs2.title.string
+            title = self.extract.title(r.read())
             if title.find("Login Failed") > 0:
                 raise Exception("Failed to authenticate as %s" % (self.username,))
  
         else:
             # no login form, already logged in
-            print "* Already logged in"
+            self.log("* Already logged in")
+
+        self.sessions.add(course_name)
+        self.save_cookies()
+
+    def save_cookies(self):
+        """Save the session cookies to the cookie file (if any)"""
+        if not self.cookie_file:
+            return
+
+        self.cookiejar.save(ignore_discard=True)
+
+        # it holds the keys to the account
+        os.chmod(self.cookie_file,0600)
 
 
     def course_name_from_url(self,course_url):
@@ -72,308 +256,985 @@ class CourseraDownloader(object):
         """Given the name of a course, return the video lecture url"""
         return self.LECTURE_URL % course_name
 
-    def get_downloadable_content(self,course_url):
+    def get_downloadable_content(self,course_url,vidpage=None):
         """Given the video lecture URL of the course, return a list of all
-        downloadable resources."""
+        downloadable resources. The lecture page is fetched unless its
+        contents are given."""
+        return CourseraDownloader.collect_lectures(self.iter_lectures(course_url,vidpage))
+
+    def iter_lectures(self,course_url,vidpage=None):
+        """Generate the lectures of the course, in order, as (weekly topic,
+        class name, resources) tuples, the resources a list of (url,filename).
+        Each lecture comes as soon as it is known: the videos that are only
+        in the lecture iframes are looked up in parallel, a few lectures
+        ahead of the consumer. A week without lectures comes as a single
+        (weekly topic, None, []) tuple."""
 
         cname = self.course_name_from_url(course_url)
 
-        print "* Collecting downloadable content from " + course_url
+        self.log("* Collecting downloadable content from " + course_url)
 
         # get the course name, and redirect to the course lecture page
-        vidpage = self.browser.open(course_url)
+        if vidpage is None:
+            vidpage = self.open_page(course_url)
 
         # extract the weekly classes
-        soup = BeautifulSoup(vidpage,self.parser)
-        headers = soup.findAll("div", { "class" : "course-item-list-header" })
+        lectures = []
+        for title,weekLectures in self.extract.lecture_index(vidpage):
+            sanitisedHeaderName = sanitiseFileName(title)
+            lectures += [(sanitisedHeaderName,l) for l in weekLectures] or [(sanitisedHeaderName,None)]
+
+        def resolve(lecture):
+            weeklyTopic,l = lecture
+            if l is None:
+                return weeklyTopic,None,[],True
+
+            lectureTitle,hrefs,lurl = l
+            className = sanitiseFileName(lectureTitle)
+
+            # for each resource of that lecture (slides, pdf, ...)
+            # (dont set a filename here, that will be inferred from the headers)
+            resourceLinks = [ (h,None) for h in hrefs]
+
+            # check if the video is included in the resources, if not, try
+            # do download it directly
+            hasvid = [x for x,_ in resourceLinks if x.find('.mp4') > 0]
+            if hasvid:
+                return weeklyTopic,className,resourceLinks,True
+
+            vurl = self.get_iframe_video(lurl)
+            if vurl:
+                # build the matching filename
+                fn = className + ".mp4"
+                resourceLinks.append( (vurl,fn) )
+            return weeklyTopic,className,resourceLinks,bool(vurl)
+
+        # (the results come back in order)
+        for weeklyTopic,className,resourceLinks,found in imap_ordered(resolve,lectures,self.crawl_workers):
+            if not found:
+                self.log(" Warning: Failed to find video for %s" %  className)
+            yield weeklyTopic,className,resourceLinks
 
+    @staticmethod
+    def collect_lectures(lectures):
+        """Return the (weeklyTopics, allClasses) structure of the lectures
+        generated by iter_lectures"""
         weeklyTopics = []
         allClasses = {}
+        for weeklyTopic,className,resourceLinks in lectures:
+            if weeklyTopic not in allClasses:
+                weeklyTopics.append(weeklyTopic)
+                allClasses[weeklyTopic] = {'classNames':[]}
 
-        # for each weekly class
-        for header in headers:
-            h3 = header.findNext('h3')
-            sanitisedHeaderName = sanitiseFileName(h3.text)
-            weeklyTopics.append(sanitisedHeaderName)
-            ul = header.next_sibling
-            lis = ul.findAll('li')
-            weekClasses = {}
-
-            # for each lecture in a weekly class
-            classNames = []
-            for li in lis:
-                className = sanitiseFileName(li.a.text)
-                classNames.append(className)
-                classResources = li.find('div', {'class':'course-lecture-item-resource'})
-
-                hrefs = classResources.findAll('a')
-
-                # for each resource of that lecture (slides, pdf, ...)
-                # (dont set a filename here, that will be inferred from the headers)
-                resourceLinks = [ (h['href'],None) for h in hrefs]
- 
-                # check if the video is included in the resources, if not, try
-                # do download it directly
-                hasvid = [x for x,_ in resourceLinks if x.find('.mp4') > 0]
-                if not hasvid:
-                    ll = li.find('a',{'class':'lecture-link'})
-                    lurl = ll['data-modal-iframe']
-                    p = self.browser.open(lurl)
-                    bb = BeautifulSoup(p,self.parser)
-                    vobj = bb.find('source',type="video/mp4")
-
-                    if not vobj:
-                        print " Warning: Failed to find video for %s" %  className
-                    else:
-                        vurl = vobj['src']
-                        # build the matching filename
-                        fn = className + ".mp4"
-                        resourceLinks.append( (vurl,fn) )
-
+            # keep track of the list of classNames in the order they appear in the html
+            if className is not None:
+                weekClasses = allClasses[weeklyTopic]
+                weekClasses['classNames'].append(className)
                 weekClasses[className] = resourceLinks
 
-            # keep track of the list of classNames in the order they appear in the html
-            weekClasses['classNames'] = classNames
+        return (weeklyTopics, allClasses)
 
-            allClasses[sanitisedHeaderName] = weekClasses
+    @staticmethod
+    def iter_classes(weeklyTopics,allClasses):
+        """Generate the lectures of a (weeklyTopics, allClasses) structure
+        like iter_lectures does"""
+        for weeklyTopic in weeklyTopics:
+            if weeklyTopic not in allClasses:
+                #print 'Weekly topic not in all classes:', weeklyTopic
+                continue
 
-        return (weeklyTopics, allClasses)
+            weekClasses = allClasses[weeklyTopic]
+            classNames = [c for c in weekClasses['classNames'] if c in weekClasses]
+            if not classNames:
+                yield weeklyTopic,None,[]
+            for className in classNames:
+                yield weeklyTopic,className,weekClasses[className]
+
+    @timed('iframes')
+    def get_iframe_video(self,lurl):
+        """Return the url of the mp4 video embedded in the lecture iframe at
+        the given url, or None if there is none"""
+        if not lurl:
+            return None
+
+        with self.host_limiter.slot(lurl):
+            p = self.open_page(lurl)
+            return self.extract.iframe_video(p)
+
+    @timed('crawl')
+    def crawl_course(self,cname,course_dir=None,stream=False,save=True):
+        """Return the structure of the course: a dict with the weeklyTopics and
+        allClasses returned by get_downloadable_content and the wiki,
+        assignment and quiz lists. If a course directory is given the result
+        is cached there (see CrawlCache); within cache_ttl seconds of the last
+        crawl the cache is used as is, after that the lectures are only parsed
+        again if the lecture index page has changed (by its ETag). Without
+        save the cache is only read.
+
+        With stream, the lectures are not looked up yet: course['lectures']
+        generates them as they are found (see iter_lectures), and only after
+        that are weeklyTopics and allClasses filled in (and cached)."""
 
-    def download(self, url, target_dir=".", target_fname=None):
-        """Download the url to the given filename"""
-        r = self.browser.open(url)
+        course_url = self.lecture_url_from_name(cname)
+
+        cache = CrawlCache(course_dir,self.cache_ttl) if course_dir and self.cache_ttl is not None else None
+        entry = cache.load() if cache else None
+        if entry and self.quiz and 'quizzes' not in entry['course']:
+            # cached without the quizzes
+            entry = None
+
+        complete = False
+        if cache and cache.is_fresh(entry):
+            self.log("* Using the cached course structure of " + cname)
+            course = entry['course']
+            lectures = CourseraDownloader.iter_classes(course['weeklyTopics'],course['allClasses'])
+        else:
+            # revalidate the lecture index
+            headers = {'If-None-Match':entry['etag']} if entry and entry['etag'] else {}
+            try:
+                r = self.open_page(course_url,headers)
+                etag = r.info().get('ETag')
+                lectures = self.iter_lectures(course_url,r.read())
+            except HTTPError as e:
+                if e.code != 304:
+                    raise
+                self.log("* Lectures of %s have not changed, using the cached ones" % cname)
+                etag = entry['etag']
+                lectures = CourseraDownloader.iter_classes(entry['course']['weeklyTopics'],entry['course']['allClasses'])
+
+            course = {'wiki':self.get_wiki_pages(cname),
+                      'assignments':self.get_assignments(cname)}
+
+            # (the quiz lists are only looked up when quizzes are downloaded)
+            complete = True
+            if self.quiz:
+                course['quizzes'] = {}
+                for qt in ['quiz','homework']:
+                    try:
+                        course['quizzes'][qt] = self.get_quizzes(cname,qt)
+                    except Exception as e:
+                        self.log("  - Failed to get the '%s' quizzes: %s" % (qt,e))
+                        course['quizzes'][qt] = []
+                        complete = False
+
+        def finish():
+            # (what is crawled after this returns still counts as crawling)
+            found = []
+            while True:
+                with self.metrics.phase('crawl',count=False):
+                    lecture = next(lectures,None)
+                if lecture is None:
+                    break
+                found.append(lecture)
+                yield lecture
+
+            with self.metrics.phase('crawl',count=False):
+                course['weeklyTopics'],course['allClasses'] = CourseraDownloader.collect_lectures(found)
+                self.log('* Got all downloadable content for ' + cname)
+
+                if cache and complete and save:
+                    cache.save(dict((k,v) for k,v in course.items() if k != 'lectures'),etag)
+
+        if stream:
+            course['lectures'] = finish()
+        else:
+            for _ in finish():
+                pass
+
+        return course
+
+    def get_wiki_pages(self,cname):
+        """Return the (url,filename) of the wiki static pages linked from the
+        navigation bar of the course"""
+        p = self.open_page(self.HOME_URL % cname)
+
+        qurls = self.extract.navbar_links(p)
+        qurls = [h for h in qurls if "page=" in h]        
+
+        pages = []
+        for url in qurls:
+            filename = url.partition("/wiki/view?page=")[2]
+            if not filename.endswith("html"):
+                filename = filename + ".html"
+            pages.append((url,filename))
+        return pages
+
+    def get_item_list(self,url):
+        """Return the (url,title) of the items (quizzes, assignments) of the
+        course item list at the given url"""
+        p = self.open_page(url)
+        return self.extract.item_list(p)
+
+    def get_quizzes(self,course,quiz_type="quiz"):
+        """Return the (url,title) of the quizzes of the given type"""
+        qurl = (self.QUIZ_URL + "?quiz_type=" + quiz_type) % course
+        return [(q.replace('/start?','/attempt?'),t) for q,t in self.get_item_list(qurl)]
+
+    def get_assignments(self,course):
+        """Return the (url,title) of the assignments"""
+        return self.get_item_list(self.ASSIGNMENT_URL % course)
+
+    def open_page(self,url,headers=None):
+        """Open the url in the browser of the calling thread, with the given
+        extra request headers, retrying on network errors and overloaded
+        servers"""
+        req = Request(url,headers=headers or {})
+        return self.controller.call(lambda: self.get_browser().open(req),url)
+
+    def open_stream(self,url,headers=None):
+        """Open the url for reading, with the given extra request headers.
+        Unlike browser.open the response is not buffered in memory, so it is
+        suitable for reading large files."""
+        req = Request(url,headers=headers or {})
+        return UserAgentBase.open(self.get_browser(),req)
+
+    def head(self,url):
+        """Return the response headers of the url, from a HEAD request"""
+        r = UserAgentBase.open(self.get_browser(),HeadRequest(url))
+        try:
+            return r.info()
+        finally:
+            r.close()
+
+    @timed('download')
+    def download(self, url, target_dir=".", target_fname=None, manifest=None, file_filter=None):
+        """Download the url to the given filename (see fetch_file), retrying
+        on network errors and overloaded servers. Returns False if the
+        download failed."""
+        try:
+            return self.controller.call(lambda: self.fetch_file(url,target_dir,target_fname,manifest,file_filter),url)
+        except Exception as e:
+            self.log("Failed to download url %s to %s: %s" % (url,os.path.join(target_dir,target_fname) if target_fname else target_dir,e))
+            return False
+
+    def fetch_file(self, url, target_dir=".", target_fname=None, manifest=None, file_filter=None):
+        """Download the url to the given filename. If a manifest is given,
+        files it records as complete are skipped without contacting the
+        server (or revalidated with a conditional request if revalidate is
+        set) and newly completed files are added to it. Errors are raised,
+        a partially downloaded file is resumed when trying again.
+
+        With a store, files it has already (known by the checksum in the
+        manifest or the ETag of the response) are linked rather than
+        downloaded, and downloaded files are added to it.
+
+        A file the filter leaves out (see Filter.file) is skipped once its
+        name and size are known from the response headers."""
+
+        # check what we know about the url already
+        entry = manifest.get(url) if manifest else None
+        cond = {}
+        if entry and not Manifest.is_complete(entry) and not self.revalidate and self.store and self.store.has(entry['sha1']):
+            # deleted since, but the store still has it
+            self.store.link(entry['sha1'],entry['filepath'])
+            self.log('    - "%s" is in the store, linking it' % os.path.basename(entry['filepath']))
+            return True
+
+        if entry and Manifest.is_complete(entry):
+            fname = os.path.basename(entry['filepath'])
+            if not self.revalidate:
+                self.log('    - "%s" already exists, skipping' % fname)
+                return True
+
+            cond = Manifest.conditional_headers(entry)
+            if not cond:
+                self.log('    - "%s" already exists, skipping' % fname)
+                return True
+
+        # a partial download whose name is known up front is resumed with the
+        # first request, others once the response headers have named them
+        known = os.path.join(target_dir,target_fname) if target_fname else entry['filepath'] if entry else None
+        offset = self.resume_offset(known) if known and not cond else 0
+        # whether the server would not resume it
+        refused = False
+
+        try:
+            r = self.open_range(url,offset) if offset else self.open_stream(url,cond)
+        except HTTPError as e:
+            if e.code == 304:
+                self.log('    - "%s" is up to date, skipping' % fname)
+                return True
+            if e.code != 416 or not offset:
+                raise
+            # the part is not shorter than the file
+            r = self.open_stream(url)
+            offset,refused = 0,True
+
+        if offset and r.code != 206:
+            # the server ignored the range, start over
+            self.log('    - "%s" cannot be resumed, downloading again' % os.path.basename(known))
+            offset,refused = 0,True
 
         # get the headers
         headers = r.info()
 
-        # get the content length (if present)
-        clen = int(headers['Content-Length']) if 'Content-Length' in headers else -1 
+        # get the content length (if present), of the whole file
+        if offset:
+            clen = CourseraDownloader.getRangeTotal(headers)
+        else:
+            clen = int(headers['Content-Length']) if 'Content-Length' in headers else -1 
  
         # build the absolute path we are going to write to
-        fname = target_fname or sanitiseFileName(CourseraDownloader.getFileName(headers)) or CourseraDownloader.getFileNameFromURL(url)
+        fname = CourseraDownloader.getTargetFileName(url,headers,target_fname)
         filepath = os.path.join(target_dir,fname)
 
+        if offset and filepath != known:
+            # (the server names it differently after all)
+            r.close()
+            return self.fetch_file(url,target_dir,fname,manifest,file_filter)
+
+        why = file_filter.file(fname,clen) if file_filter else None
+        if why:
+            r.close()
+            self.log('    - "%s" is left out by its %s, skipping' % (fname,why))
+            return True
+
+        # the store may have it from another course
+        etag = headers.get('ETag')
+        sha1 = self.store.lookup(etag,clen) if self.store and (cond or not os.path.exists(filepath)) else None
+        if sha1:
+            r.close()
+            self.store.link(sha1,filepath)
+            self.log('    - "%s" is in the store, linking it' % fname)
+            if manifest:
+                manifest.add(url,filepath,clen,etag,headers.get('Last-Modified'),sha1)
+            return True
+
+        # an interrupted download is left in the part file
+        part = filepath + PartFile.SUFFIX
+
+        # the segments we already have (when resuming a segmented download)
+        seg = None
+
         dl = True
-        if os.path.exists(filepath):
+        if cond:
+            # the conditional request did not give a 304, so it changed
+            self.log('    - "%s" has changed, downloading again' % fname)
+        elif os.path.exists(filepath):
+            # files only get their name once complete, but those written by
+            # older versions may not be
             if clen > 0: 
                 fs = os.path.getsize(filepath)
                 delta = clen - fs
 
                 # all we know is that the current filesize may be shorter than it should be and the content length may be incorrect
-                # overwrite the file if the reported content length is bigger than what we have already by at least k bytes (arbitrary)
-
-                # TODO this is still not foolproof as the fundamental problem is that the content length cannot be trusted
-                # so this really needs to be avoided and replaced by something else, eg., explicitly storing what downloaded correctly
+                # resume the file if the reported content length is bigger than what we have already by at least k bytes (arbitrary)
+                # (files recorded in the manifest do not get here, so this is only a guess for files it does not know about yet)
                 if delta > 2:
-                    print '    - "%s" seems incomplete, downloading again' % fname
+                    self.log('    - "%s" seems incomplete, resuming at byte %d' % (fname,fs))
+                    # (appending to a file linked from the store would
+                    # change the copies of the other courses too)
+                    detach(filepath,part)
+                    offset = fs
                 else:
-                    print '    - "%s" already exists, skipping' % fname
+                    self.log('    - "%s" already exists, skipping' % fname)
                     dl = False
             else:
                 # missing or invalid content length
                 # assume all is ok...
                 dl = False
+        elif os.path.exists(part):
+            fs = os.path.getsize(part)
+            seg = SegmentedPart(filepath,clen,etag)
+            if seg.load():
+                self.log('    - "%s" was partly downloaded, resuming %d of %d segments' % (fname,len(seg.missing()),len(seg.ranges)))
+            else:
+                seg = None
+
+            # (a part as big as the file without its segments is left by an
+            # older version, and cannot be resumed)
+            if not seg and not refused and fs and (clen < 0 or fs < clen):
+                self.log('    - "%s" was partly downloaded, resuming at byte %d' % (fname,fs))
+                offset = fs
 
         try:
-            if dl: self.browser.retrieve(url,filepath)
+            if dl:
+                if offset and r.code != 206:
+                    r.close()
+                    r = self.open_range(url,offset)
+                    if r.code != 206:
+                        # the server ignored the range, start over
+                        self.log('    - "%s" cannot be resumed, downloading again' % fname)
+                        offset = 0
+
+                res = None
+                if seg or (not offset and self.use_segments(headers,clen)):
+                    r.close()
+                    res = self.download_segmented(url,filepath,clen,etag,seg)
+                    if not res:
+                        self.log('    - "%s" cannot be downloaded in parts, downloading it in one go' % fname)
+                        r = self.open_stream(url)
+
+                size,sha1 = res or self.write_response(r,filepath,offset)
+                self.metrics.add_file()
+            else:
+                # adopt the existing file into the manifest
+                size,sha1 = os.path.getsize(filepath),file_sha1(filepath).hexdigest()
+
+            if self.store:
+                self.store.add(filepath,sha1,size,r.info().get('ETag'))
+            if manifest:
+                manifest.add(url,filepath,size,r.info().get('ETag'),r.info().get('Last-Modified'),sha1)
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # there is nothing left beyond what we already have
+            self.log('    - "%s" already complete, skipping' % fname)
+            if os.path.exists(part):
+                replace(part,filepath)
+        finally:
+            r.close()
+
+        return True
+
+    def resume_offset(self,filepath):
+        """Return the size of the part file of an interrupted download of
+        filepath that can be resumed from there (see PartFile), or 0"""
+        part = filepath + PartFile.SUFFIX
+        # (segmented downloads are resumed by segment)
+        if os.path.exists(filepath) or not os.path.exists(part) or os.path.exists(part + SegmentedPart.SUFFIX):
+            return 0
+        return os.path.getsize(part)
+
+    def open_range(self,url,offset):
+        """Request the url from the given byte offset onwards. Check the code
+        of the response: if it is not 206 the server ignored the range and
+        the response holds the complete file."""
+        r = self.open_stream(url,{'Range':'bytes=%d-' % offset})
+
+        if r.code == 206 and CourseraDownloader.getRangeStart(r.info()) != offset:
+            # not the part we asked for, get the whole thing instead
+            r.close()
+            r = self.open_stream(url)
+
+        return r
+
+    def use_segments(self,headers,clen):
+        """True if a file with the given response headers is big enough to be
+        downloaded in segments, and the server supports that"""
+        return (self.segments > 1 and clen >= self.segment_threshold and
+                headers.get('Accept-Ranges','').lower() == 'bytes')
+
+    def download_segmented(self,url,filepath,clen,etag=None,seg=None):
+        """Download the url in segments over parallel connections (see
+        SegmentedPart), each segment retried on its own. The file is only
+        moved into place when all segments have been verified. If some fail,
+        those that did not are kept and the next attempt (or run) resumes the
+        others, given as seg. Returns the size and sha1 checksum of the file,
+        or None if the server does not return the requested ranges after
+        all."""
+        if seg is None:
+            seg = SegmentedPart(filepath,clen,etag)
+            seg.create(self.segments)
+
+        # (the segment threads count towards the phase of the caller)
+        phase = self.metrics.current()
+
+        def fetch(item):
+            i,(start,end) = item
+            try:
+                fn = lambda: self.download_segment(url,seg.path,start,end,etag)
+                with self.metrics.attribute(phase):
+                    if not self.controller.call(fn,url,nested=True):
+                        return False
+            except Exception:
+                # (raised once all the segments are done with)
+                return sys.exc_info()
+            seg.finished(i)
+            return True
+
+        # the segments are fetched over the slot of the job for the host and
+        # as many more as are free, so there are never more than per_host
+        # connections to it, nor more than the adaptive limit of the
+        # controller allows (which shrinks when the server is overloaded)
+        with self.host_limiter.extra(url,self.segments - 1) as extra:
+            with self.controller.extra(url,extra) as extra:
+                results = list(imap_ordered(fetch,seg.missing(),1 + extra))
+        for res in results:
+            if isinstance(res,tuple):
+                raise res[0],res[1],res[2]
+
+        if not all(results):
+            seg.discard()
+            return None
+
+        seg.commit()
+        return clen,file_sha1(filepath).hexdigest()
+
+    def download_segment(self,url,filepath,start,end,etag=None):
+        """Download bytes start-end (inclusive) of the url to the same offset
+        in the file, raises an IOError if they do not all arrive. Returns False
+        if the server ignored the range. With an ETag the range is made
+        conditional (If-Range), so a file that changed meanwhile is not
+        stitched together from two versions."""
+        headers = {'Range':'bytes=%d-%d' % (start,end)}
+        if etag:
+            headers['If-Range'] = etag
+
+        r = self.open_stream(url,headers)
+        try:
+            if r.code != 206 or CourseraDownloader.getRangeStart(r.info()) != start:
+                return False
+
+            left = end - start + 1
+            with open(filepath,'r+b') as f:
+                f.seek(start)
+                while left > 0:
+                    block = r.read(min(self.chunk_size,left))
+                    if not block:
+                        break
+                    f.write(block)
+                    self.metrics.add_bytes(len(block))
+                    left -= len(block)
+
+            if left:
+                raise IOError("segment %d-%d incomplete, %d bytes missing" % (start,end,left))
+        finally:
+            r.close()
+
+        return True
+
+    def write_response(self,r,filepath,offset=0):
+        """Write the body of the response to filepath (see PartFile), appending
+        to the first offset bytes of the part file if offset is given. The
+        file only appears under its name once it is complete. Returns the
+        size and sha1 checksum of the resulting file."""
+        clen = int(r.info()['Content-Length']) if 'Content-Length' in r.info() else -1
+        read = 0
+
+        # the checksum covers the part we already have too
+        h = file_sha1(filepath + PartFile.SUFFIX,offset) if offset else hashlib.sha1()
+
+        # (replacing the file rather than writing to it also leaves the
+        # copies linked from the store alone)
+        part = PartFile(filepath,offset + clen if clen >= 0 else -1,offset)
+        try:
+            while True:
+                block = r.read(self.chunk_size)
+                if not block:
+                    break
+                part.write(block)
+                self.metrics.add_bytes(len(block))
+                h.update(block)
+                read += len(block)
+
+            part.commit()
+        finally:
+            part.close()
+
+        return offset + read,h.hexdigest()
+
+    def download_job(self,job):
+        """Run a single job (see Job and plan_course), sets job.ok to whether
+        it succeeded. The output of the job is collected and returned so it
+        can be printed in one go, rather than interleaved with that of jobs
+        running in parallel."""
+        self._local.output = job.notes + job.lines
+
+        job.ok = False
+        try:
+            if not job.url:
+                job.ok = True
+            else:
+                pack = self.get_pack(job.course_dir) if self.pack else None
+                target = self.job_path(job)
+                before = filestamp(target) if target else None
+
+                if pack and target and pack.has(target):
+                    self.log('    - "%s" is in the pack, skipping' % os.path.basename(target))
+                    job.ok = True
+                else:
+                    with self.host_limiter.slot(job.url):
+                        if job.kind == 'quiz':
+                            # (retries its page itself)
+                            job.ok = self.download_quiz(job.url,os.path.join(job.target_dir,job.target_fname))
+                        elif job.kind == 'assignment':
+                            fn = lambda: self.download_item(job.url,os.path.join(job.target_dir,job.target_fname))
+                            job.ok = self.controller.call(fn,job.url)
+                        else:
+                            # (archived pages are changed, so their size says nothing about them being complete anymore)
+                            manifest = self.get_manifest(job.course_dir) if job.kind == 'file' or self.archive_pages else None
+                            job.ok = self.download(job.url,target_dir=job.target_dir,target_fname=job.target_fname,manifest=manifest,
+                                                   file_filter=self.filter if job.kind == 'file' else None)
+
+                        if job.ok and job.kind != 'file' and self.archive_pages and filestamp(target) != before:
+                            self.archive_page(job,target)
+
+                    # (the name of a lecture file may only be known now)
+                    target = target or self.job_path(job)
+                    # (archived pages stay loose, next to the assets directory
+                    # their links point to)
+                    archived = self.archive_pages and job.kind != 'file'
+                    if job.ok and pack and target and not archived and os.path.isfile(target):
+                        pack.add(target)
         except Exception as e:
-            print "Failed to download url %s to %s: %s" % (url,filepath,e)
+            self.log("    - failed: %s %s" % (job.url,e))
+        finally:
+            out = self._local.output
+            self._local.output = None
+
+        return out
+
+    def job_path(self,job):
+        """Return the path of the file of the job, or None if it is not known
+        (yet; lecture files are named after the response headers)"""
+        if job.target_fname:
+            return os.path.join(job.target_dir,job.target_fname)
+        if job.kind == 'file' and os.path.exists(os.path.join(job.course_dir,Manifest.FILENAME)):
+            entry = self.get_manifest(job.course_dir).get(job.url)
+            return entry['filepath'] if entry else None
+        return None
+
+    @timed('archive')
+    def archive_page(self,job,filepath):
+        """Make the saved page of the job use the copies of its assets in the
+        asset cache of the course (see AssetCache)"""
+        with open(filepath,'rb') as f:
+            html = f.read()
+
+        out = self.get_assets(job.course_dir).localize(html,job.url,filepath)
+        if out == html:
+            return
+
+        write_file(filepath,out)
+
+        # record the new size, so the page is not taken for an incomplete one
+        manifest = self.get_manifest(job.course_dir)
+        entry = manifest.get(job.url)
+        if entry:
+            manifest.add(job.url,filepath,len(out),entry['etag'],entry['last_modified'],hashlib.sha1(out).hexdigest())
+
+    @timed('plan')
+    def plan_job(self,job):
+        """Return what running the job would do, without downloading
+        anything: a dict with the target path, the size (None if unknown) and
+        the status, which is 'present', 'in-store' (linked from the store),
+        'needs-download', 'filtered' (left out by the filter) or 'error' (see
+        Planner)"""
+        entry = {'course':job.course,'kind':job.kind,'url':job.url,'path':None,'size':None,
+                 'status':'needs-download','error':None}
+
+        path = self.job_path(job)
+        if path and self.pack and self.get_pack(job.course_dir).has(path):
+            entry.update(path=path,status='present')
+            return entry
+
+        if job.kind in ('quiz','assignment'):
+            # (requesting these may start an attempt, so they are only looked for on disk)
+            entry['path'] = path
+            if os.path.exists(entry['path']):
+                entry.update(status='present',size=os.path.getsize(entry['path']))
+            return entry
+
+        # only look at an existing manifest, planning does not write anything
+        manifest = None
+        if job.kind == 'file' and os.path.exists(os.path.join(job.course_dir,Manifest.FILENAME)):
+            manifest = self.get_manifest(job.course_dir)
+        known = manifest.get(job.url) if manifest else None
+        if known and Manifest.is_complete(known) and not self.revalidate:
+            entry.update(path=known['filepath'],size=known['size'],status='present')
+            return entry
+
+        try:
+            with self.host_limiter.slot(job.url):
+                headers = self.controller.call(lambda: self.head(job.url),job.url)
+        except Exception as e:
+            if job.target_fname:
+                entry['path'] = os.path.join(job.target_dir,job.target_fname)
+            entry.update(status='error',error=str(e))
+            return entry
+
+        clen = int(headers['Content-Length']) if 'Content-Length' in headers else -1
+        filepath = os.path.join(job.target_dir,CourseraDownloader.getTargetFileName(job.url,headers,job.target_fname))
+        entry.update(path=filepath,size=clen if clen >= 0 else None)
+
+        if job.kind == 'file' and self.filter and self.filter.file(os.path.basename(filepath),clen):
+            entry['status'] = 'filtered'
+        elif known and Manifest.is_complete(known):
+            # revalidating, the same version is still there
+            if known['etag'] and known['etag'] == headers.get('ETag'):
+                entry['status'] = 'present'
+        elif os.path.exists(filepath) and not known and (clen < 0 or clen - os.path.getsize(filepath) <= 2):
+            # (the same guess as fetch_file makes)
+            entry['status'] = 'present'
+        elif self.store and self.store.lookup(headers.get('ETag'),clen):
+            entry['status'] = 'in-store'
+
+        return entry
 
     def download_course(self,cname,dest_dir="."):
         """Download all the contents (quizzes, videos, lecture notes, ...) of the course to the given destination directory (defaults to .)"""
 
+        # (the downloads start while the lectures are still being looked up)
+        jobs = self.plan_course(cname,dest_dir,stream=True)
+        try:
+            for out in imap_ordered(self.download_job,jobs,self.workers):
+                for l in out: print l
+        finally:
+            self.close_manifests()
+            self.controller.print_failures()
+
+    def plan_course(self,cname,dest_dir=".",create_dirs=True,stream=False):
+        """Log in, collect the contents of the course and return the list of
+        jobs that download all of it (standard pages, wiki pages, assignments,
+        quizzes and the lecture resources, in that order) to the course
+        directory in dest_dir. Only the directories are created and the crawl
+        cached (unless create_dirs is False, then nothing is written).
+
+        With stream a generator of the jobs is returned instead, which
+        yields the jobs of the lectures as they are found (see iter_lectures),
+        so they can be downloaded while the rest of the course is crawled."""
+        jobs = self.iter_course_jobs(cname,dest_dir,create_dirs)
+        return self.with_notes(cname,jobs) if stream else list(jobs)
+
+    def with_notes(self,cname,jobs):
+        """Generate the jobs, each with the messages logged while it was
+        planned as its notes (see Job), so they are printed with its output
+        rather than from the planning thread in between the output of the
+        jobs that are running"""
+        notes = []
+        priority = 0
+        while True:
+            prev = getattr(self._local,'output',None)
+            self._local.output = notes
+            try:
+                job = next(jobs,None)
+            finally:
+                self._local.output = prev
+            if job is None:
+                break
+
+            job.notes,notes = notes,[]
+            priority = job.priority
+            yield job
+
+        # (through a job without a url, like the trailing progress lines)
+        if notes:
+            job = Job(cname,'file',None,None,priority=priority)
+            job.notes = notes
+            yield job
+
+    def iter_course_jobs(self,cname,dest_dir=".",create_dirs=True):
         # Ensure we are logged in
         self.login(cname)
 
         # get the lecture url
         course_url = self.lecture_url_from_name(cname)
 
-        (weeklyTopics, allClasses) = self.get_downloadable_content(course_url)
-        print '* Got all downloadable content for ' + cname
-
         course_dir = os.path.abspath(os.path.join(dest_dir,cname))
 
-        # ensure the target dir exists
-        if not os.path.exists(course_dir):
-            os.mkdir(course_dir)
-
-        print "* " + cname + " will be downloaded to " + course_dir
-
         # ensure the course directory exists
-        if not os.path.exists(course_dir):
+        if create_dirs and not os.path.exists(course_dir):
             os.makedirs(course_dir)
 
-        # download the standard pages
-        print " - Downloading lecture/syllabus pages"
-        self.download(self.HOME_URL % cname,target_dir=course_dir,target_fname="index.html")
-        self.download(course_url,target_dir=course_dir,target_fname="lectures.html")
+        # (the crawl is cached in the course directory, if there is one)
+        course = self.crawl_course(cname,course_dir if os.path.isdir(course_dir) else None,stream=True,save=create_dirs)
 
-        #search for wiki static pages in navigation and save
-        p = self.browser.open(self.HOME_URL % cname)
-        bs = BeautifulSoup(p,self.parser)
+        self.log("* " + cname + " will be downloaded to " + course_dir)
 
-        qlist = bs.find('ul',{'class':'course-navbar-list'})
-        qurls = [q['href'] for q in qlist.findAll('a')]
-        qurls = [h for h in qurls if "page=" in h]        
-        for url in qurls:
-            filename = url.partition("/wiki/view?page=")[2]
-            if not filename.endswith("html"):
-                filename = filename + ".html"
-                self.download(url,target_dir=course_dir,target_fname=filename)
+        # the standard pages
+        jobs = [Job(cname,'page',self.HOME_URL % cname,course_dir,"index.html",lines=[" - Downloading lecture/syllabus pages"]),
+                Job(cname,'page',course_url,course_dir,"lectures.html")]
 
+        # the wiki static pages found in the navigation
+        jobs += [Job(cname,'page',url,course_dir,filename) for url,filename in course['wiki']]
 
-        #download assignments
-        self.download_assignments(cname,course_dir)
-        
-        # download the quizzes & homework if quiz flag is set in startup.
-        
+        jobs += self.item_jobs(cname,course['assignments'],course_dir,"assignments",'assignment',create_dirs=create_dirs)
+
+        # the quizzes & homework if quiz flag is set in startup.
         if self.quiz:
             for qt in ['quiz','homework']:
-                print "  - Downloading the '%s' quizzes" % qt
-                try:
-                    self.download_quizzes(cname,course_dir,quiz_type=qt)
-                except Exception as e:
-                   print "  - Failed %s" % e
-
-        
+                jobs += self.item_jobs(cname,course['quizzes'][qt],course_dir,qt,'quiz',
+                                       lines=["  - Downloading the '%s' quizzes" % qt],create_dirs=create_dirs)
+
+        # the actual content (video's, lecture notes, ...)
+        lecture_jobs = self.lecture_jobs(cname,course['lectures'],course_url,course_dir,create_dirs)
+        if self.order != 'course':
+            # (all the lectures are looked up before the first one is downloaded)
+            lecture_jobs = self.order_jobs(list(lecture_jobs))
+
+        for i,job in enumerate(itertools.chain(jobs,lecture_jobs)):
+            job.priority = i
+            yield job
+
+    def order_jobs(self,jobs):
+        """Return the lecture jobs in the order of the downloader: 'newest'
+        for the last week first (the lectures of a week stay in order) or
+        'smallest' for the smallest files first (their sizes are looked up
+        as plan_job does, files of unknown size come last)"""
+        # (the job without a url, if any, only carries the last progress lines)
+        tail = [j for j in jobs if not j.url]
+        jobs = [j for j in jobs if j.url]
+
+        if self.order == 'newest':
+            # (the week directories are numbered)
+            jobs.sort(key=lambda j: os.path.relpath(j.target_dir,j.course_dir).split(os.sep)[0],reverse=True)
+        elif self.order == 'smallest':
+            sizes = list(imap_ordered(lambda j: self.plan_job(j)['size'],jobs,self.crawl_workers))
+            jobs = [j for size,_,j in sorted(zip([(s is None,s) for s in sizes],itertools.count(),jobs))]
+
+            # the progress lines are no longer in the right place
+            for j in jobs + tail:
+                j.lines = []
+            if jobs:
+                jobs[0].lines = [" - Downloading the lecture resources, smallest first"]
+            tail = []
+
+        return jobs + tail
+
+    def item_jobs(self,cname,items,course_dir,dirname,kind,lines=None,create_dirs=True):
+        """Return the jobs to download the (url,title) items (quizzes or
+        assignments) as separate html files in the given sub directory"""
 
-        # now download the actual content (video's, lecture notes, ...)
-        for j,weeklyTopic in enumerate(weeklyTopics,start=1):
-            if weeklyTopic not in allClasses:
-                #print 'Weekly topic not in all classes:', weeklyTopic
-                continue
-
-            # ensure the week dir exists
-            # add a numeric prefix to the week directory name to ensure chronological ordering
-            wkdirname = str(j).zfill(2) + " - " + weeklyTopic
-            wkdir = os.path.join(course_dir,wkdirname)
-            if not os.path.exists(wkdir):
-                os.makedirs(wkdir)
-
-            weekClasses = allClasses[weeklyTopic]
-            classNames = weekClasses['classNames']
+        #check to see if any URLs found before creating directory.
+        if not items:
+            return []
 
-            print " - " + weeklyTopic
+        # ensure the target directory exists
+        dir = os.path.join(course_dir,dirname)
 
-            for i,className in enumerate(classNames,start=1):
-                if className not in weekClasses:
-                    continue
+        try:
+            if create_dirs:
+                os.makedirs(dir)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                pass
+            else: raise
 
-                classResources = weekClasses[className]
+        jobs = []
+        for i,it in enumerate(items,start=1):
+            q,t = it
+            fname = str(i).zfill(2) + " - " + sanitiseFileName(t) + ".html"
+            jobs.append(Job(cname,kind,q,dir,fname,course_dir))
+
+        jobs[0].lines = lines or []
+        return jobs
+
+    def lecture_jobs(self,cname,lectures,course_url,course_dir,create_dirs=True):
+        """Create the week/class directories and generate the download jobs
+        for every lecture resource, in course order, as the lectures (see
+        iter_lectures) come in. Only the weeks, lectures and resources that
+        pass the filter are included (those left out keep their number)."""
+
+        # progress lines are carried by the first job that follows them
+        lines = []
+
+        f = self.filter
+        week = None
+        j = 0
+        for weeklyTopic,className,classResources in lectures:
+            if weeklyTopic != week:
+                week = weeklyTopic
+                j += 1
+                i = 0
+
+                selected = f is None or f.week(j)
+                if selected:
+                    # ensure the week dir exists
+                    # add a numeric prefix to the week directory name to ensure chronological ordering
+                    wkdirname = str(j).zfill(2) + " - " + weeklyTopic
+                    wkdir = os.path.join(course_dir,wkdirname)
+                    if create_dirs and not os.path.exists(wkdir):
+                        os.makedirs(wkdir)
+
+                    lines.append(" - " + weeklyTopic)
+
+            if className is None:
+                continue
+            i += 1
 
-                # ensure the class dir exists
-                clsdirname = str(i).zfill(2) + " - " + className
-                clsdir = os.path.join(wkdir,clsdirname)
-                if not os.path.exists(clsdir): 
-                    os.makedirs(clsdir)
+            if not selected or (f and not f.lecture(className)):
+                continue
 
-                print "  - ources for " + className
+            msgs = []
+            resources = []
+            for classResource,tfname in classResources:
+                if not isValidURL(classResource):
+                    absoluteURLGen = AbsoluteURLGen(course_url)
+                    classResource = absoluteURLGen.get_absolute(classResource)
+                    msgs.append("  -" + classResource + ' - is not a valid url')
 
-                for classResource,tfname in classResources:
                     if not isValidURL(classResource):
-                        absoluteURLGen = AbsoluteURLGen(course_url)
-                        classResource = absoluteURLGen.get_absolute(classResource)
-                        print "  -" + classResource, ' - is not a valid url'
-
-                        if not isValidURL(classResource):
-                            print "  -" + classResource, ' - is not a valid url'
-                            continue
+                        msgs.append("  -" + classResource + ' - is not a valid url')
+                        continue
 
-                    try:
-                       #print '  - Downloading ', classResource
-                       self.download(classResource,target_dir=clsdir,target_fname=tfname)
-                    except Exception as e:
-                       print "    - failed: ",classResource,e
-
-
-    def download_quizzes(self,course,target_dir,quiz_type="quiz"):
-        """Download each of the quizzes as separate html files, the quiz type is
-        typically quiz or homework"""
-
-        # extract the list of all quizzes
-        qurl = (self.QUIZ_URL + "?quiz_type=" + quiz_type) % course
-        p = self.browser.open(qurl)
-        bs = BeautifulSoup(p,self.parser)
+                # (resources named by the response headers are checked when downloaded)
+                if f and f.file(resource_name(classResource,tfname)):
+                    continue
+                resources.append((classResource,tfname))
 
-        qlist = bs.find('div',{'class':'course-item-list'})
-        qurls = [q['href'].replace('/start?','/attempt?') for q in qlist.findAll('a',{'class':'btn-primary'})]
-        titles = [t.string for t in qlist.find_all('h4')]
-        
-        #check to see if any URLs found before creating directory.
-        if not qurls:
-            return
-        
-        # ensure the target directory exists
-        dir = os.path.join(target_dir,quiz_type)
+            if not resources and f:
+                continue
 
-        try:
-            os.makedirs(dir)
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                pass
-            else: raise
+            # ensure the class dir exists
+            clsdirname = str(i).zfill(2) + " - " + className
+            clsdir = os.path.join(wkdir,clsdirname)
+            if create_dirs and not os.path.exists(clsdir): 
+                os.makedirs(clsdir)
+
+            lines.append("  - ources for " + className)
+            lines += msgs
+
+            for classResource,tfname in resources:
+                yield Job(cname,'file',classResource,clsdir,tfname,course_dir,lines=lines)
+                lines = []
+
+        # flush any trailing progress lines through a job without a url
+        if lines:
+            yield Job(cname,'file',None,course_dir,lines=lines)
+
+    def download_quizzes(self,quizzes,target_dir,quiz_type="quiz"):
+        """Download each of the (url,title) quizzes (see get_quizzes) as
+        separate html files, the quiz type is typically quiz or homework"""
+        for job in self.item_jobs(None,quizzes,target_dir,quiz_type,'quiz'):
+            self.download_quiz(job.url,os.path.join(job.target_dir,job.target_fname))
+
+    @timed('quizzes')
+    def download_quiz(self,url,fname):
+        """Download a single quiz to the file, starting it first if needed.
+        Only the quiz page is retried, not starting the quiz (which would
+        start another attempt)."""
+        if os.path.exists(fname):
+            #print "  - already exists, skipping"
+            return True
+
+        browser = self.get_browser()
+        quiz = self.open_page(url)
+        if self.extract.has_quiz_start_form(quiz):
+            self.log("Starting and Downloading Quiz")
+            browser.select_form(nr=0)
+            r = browser.submit()
+            content = r.read()
+        else:   
+            self.log("Downloading Quiz")
+            quiz.seek(0)
+            content = quiz.read()
+
+        write_file(fname,content)
+        self.metrics.add_bytes(len(content))
+        self.metrics.add_file()
+        return True
 
-        # download each quiz
-        for i,it in enumerate(zip(qurls,titles),start=1):
-            q,t = it
-            fname = os.path.join(dir,str(i).zfill(2) + " - " + sanitiseFileName(t) + ".html")
-            
-            if os.path.exists(fname):
-                pass
-                #print "  - already exists, skipping"
-            else:
-                quiz = self.browser.open(q)
-                bs = BeautifulSoup(quiz,self.parser)
-                startform = bs.findAll("form", {"class":"course-quiz-start-form"})
-                if startform:
-                    print "Starting and Downloading Quiz"
-                    self.browser.select_form(nr=0)
-                    r = self.browser.submit()
-                    content = r.read()
-                    with open(fname, "w") as f:
-                        f.write(content)
-                    
-                else:   
-                    print "Downloading Quiz" 
-                    self.browser.retrieve(q,fname)
-
-    def download_assignments(self,course,target_dir):
-        """Download each of the assignments as separate html files"""
-
-        # extract the list of all assignments
-        qurl = (self.ASSIGNMENT_URL) % course
-        p = self.browser.open(qurl)
-        bs = BeautifulSoup(p,self.parser)
-
-        qlist = bs.find('div',{'class':'course-item-list'})
-        qurls = [q['href'] for q in qlist.findAll('a',{'class':'btn-primary'})]
-        titles = [t.string for t in qlist.find_all('h4')]
-        
-        #check to see if any URLs found before creating directory.
-        if not qurls:
-            return
+    def download_assignments(self,assignments,target_dir):
+        """Download each of the (url,title) assignments (see get_assignments)
+        as separate html files"""
+        for job in self.item_jobs(None,assignments,target_dir,"assignments",'assignment'):
+            self.download_item(job.url,os.path.join(job.target_dir,job.target_fname))
 
-        # ensure the target directory exists
-        dir = os.path.join(target_dir,"assignments")
+    @timed('assignments')
+    def download_item(self,url,fname):
+        """Download the url to the file unless it exists already"""
+        if os.path.exists(fname):
+            #print "  - already exists, skipping"
+            return True
 
+        r = self.open_stream(url)
         try:
-            os.makedirs(dir)
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                pass
-            else: raise
-
-        # download each one
-        for i,it in enumerate(zip(qurls,titles),start=1):
-            q,t = it
-            fname = os.path.join(dir,str(i).zfill(2) + " - " + sanitiseFileName(t) + ".html")
-            
-            if os.path.exists(fname):
-                pass
-                #print "  - already exists, skipping"
-            else:
-                #print "Found assignment" 
-                self.browser.retrieve(q,fname)
+            self.write_response(r,fname)
+            self.metrics.add_file()
+        finally:
+            r.close()
+        return True
 
     @staticmethod
     def extractFileName(contentDispositionString):
@@ -392,6 +1253,24 @@ class CourseraDownloader(object):
         except Exception:
             return '' 
 
+    @staticmethod
+    def getTargetFileName(url,header,target_fname=None):
+        """Return the name the url is saved as: the given one, the one in the
+        Content-Disposition header, or the one in the url"""
+        return target_fname or sanitiseFileName(CourseraDownloader.getFileName(header)) or CourseraDownloader.getFileNameFromURL(url)
+
+    @staticmethod
+    def getRangeStart(header):
+        """Return the first byte position of a Content-Range header, or -1"""
+        m = re.match(r'bytes (\d+)-', header.get('Content-Range',''))
+        return int(m.group(1)) if m else -1
+
+    @staticmethod
+    def getRangeTotal(header):
+        """Return the size of the whole file of a Content-Range header, or -1"""
+        m = re.match(r'bytes [^/]*/(\d+)', header.get('Content-Range',''))
+        return int(m.group(1)) if m else -1
+
     @staticmethod
     def getFileNameFromURL(url):
         splits = url.split('/')
@@ -407,6 +1286,18 @@ class CourseraDownloader(object):
 
         return sanitiseFileName(fname)
 
+class HeadRequest(Request):
+    def get_method(self):
+        return "HEAD"
+
+def filestamp(path):
+    """Return something that changes when the file is (re)written, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino,st.st_mtime,st.st_size)
+
 def sanitiseFileName(fileName):
     # ensure a clean, valid filename (arg may be both str and unicode)
 
@@ -508,10 +1399,73 @@ def main():
     parser.add_argument("-q", dest='parser', type=str, default=CourseraDownloader.DEFAULT_PARSER,
                         help="the html parser to use, see http://www.crummy.com/software/BeautifulSoup/bs4/doc/#installing-a-parser")
     parser.add_argument("--quiz", dest='quiz', action="store_true", default=False, help="Allow downloading of quizzes. May trigger quiz attempts")
-    parser.add_argument('course_names', nargs="+", metavar='<course name>',
+    parser.add_argument("-j", dest='workers', type=int, default=CourseraDownloader.DEFAULT_WORKERS, help='number of files to download in parallel')
+    parser.add_argument("--per-host", dest='per_host', type=int, default=CourseraDownloader.DEFAULT_PER_HOST,
+                        help='maximum number of parallel downloads from a single host (0 for no limit)')
+    parser.add_argument("--crawl-workers", dest='crawl_workers', type=int, default=CourseraDownloader.DEFAULT_CRAWL_WORKERS,
+                        help='number of lecture pages to fetch in parallel when collecting the downloadable content')
+    parser.add_argument("--revalidate", dest='revalidate', action="store_true", default=False,
+                        help='check with the server whether files that were downloaded before have changed, rather than skipping them')
+    parser.add_argument("--cache-ttl", dest='cache_ttl', type=int, default=CourseraDownloader.DEFAULT_CACHE_TTL,
+                        help='use the cached course structure without checking for changes if it is less than this many seconds old')
+    parser.add_argument("--no-cache", dest='cache_ttl', action="store_const", const=None,
+                        help='do not cache the course structure, always scrape the complete course')
+    parser.add_argument("--segments", dest='segments', type=int, default=CourseraDownloader.DEFAULT_SEGMENTS,
+                        help='download large files in this many parts over parallel connections')
+    parser.add_argument("--segment-threshold", dest='segment_threshold', type=int, default=CourseraDownloader.DEFAULT_SEGMENT_THRESHOLD // (1024*1024),
+                        help='minimum size (in MB) of the files that are downloaded in parts')
+    parser.add_argument("--retries", dest='retries', type=int, default=CourseraDownloader.DEFAULT_RETRIES,
+                        help='number of times to retry a request that fails because of a network error or a busy server')
+    parser.add_argument("--chunk-size", dest='chunk_size', type=int, default=CourseraDownloader.DEFAULT_CHUNK_SIZE // 1024,
+                        help='number of KB read and written at a time when downloading')
+    parser.add_argument("-c", dest='cookie_file', type=str,
+                        help='file to keep the login session in, so the next run does not have to log in again')
+    parser.add_argument("--store", dest='store_dir', type=str,
+                        help='directory of a store shared by all courses, in which each downloaded file is kept once and linked into the course directories')
+    parser.add_argument("--plan", dest='plan_file', type=str,
+                        help='only plan the download: write the files, their sizes and whether they need downloading to this json (or .csv) file')
+    parser.add_argument("--metrics", dest='metrics_file', type=str,
+                        help='write the request counts, latencies, bytes and time per phase of the run to this json file')
+    parser.add_argument("--prometheus", dest='prometheus_file', type=str,
+                        help='write the same metrics to this file in the Prometheus text format')
+    parser.add_argument("--progress", dest='progress', action="store_true", default=False,
+                        help='show the number of files and MB downloaded and the download rate')
+    parser.add_argument("--archive-pages", dest='archive_pages', action="store_true", default=False,
+                        help='also save the stylesheets, scripts and images of the saved pages (once per course), so they render offline')
+    parser.add_argument("--pack", dest='pack', action="store_true", default=False,
+                        help='keep the files of each course in a single zip file in the course directory')
+    parser.add_argument("--pack-loose-size", dest='pack_loose_size', type=int,
+                        help='keep the files of at least this many MB (i.e. the videos) out of the zip file')
+    parser.add_argument("--watch", dest='watch', type=float,
+                        help='keep running, and check the courses for new content every this many minutes')
+    parser.add_argument("--no-keep-alive", dest='keep_alive', action="store_false", default=True,
+                        help='open a new connection for every request')
+    parser.add_argument("--weeks", dest='weeks', type=parse_weeks,
+                        help='only download the lectures of these weeks, e.g. 1,3-5')
+    parser.add_argument("--lecture", dest='lecture_patterns', action="append",
+                        help='only download the lectures whose name matches this regular expression (can be given more than once)')
+    parser.add_argument("--ext", dest='extensions', type=str,
+                        help='only download the lecture resources with these extensions, e.g. pdf,pptx')
+    parser.add_argument("--max-size", dest='max_size', type=int,
+                        help='skip the lecture resources bigger than this (in MB)')
+    parser.add_argument("--order", dest='order', choices=CourseraDownloader.ORDERS, default=CourseraDownloader.DEFAULT_ORDER,
+                        help="the order of the lecture downloads: 'newest' week first or 'smallest' file first (default: course order)")
+    parser.add_argument("--coordinate", dest='coordinate_dir', type=str,
+                        help='plan the courses into this job directory for --worker processes, without downloading')
+    parser.add_argument("--worker", dest='worker_dir', type=str,
+                        help='download a share of the jobs in this job directory (written by --coordinate)')
+    parser.add_argument("--shard", dest='shard', type=parse_shard,
+                        help='with --worker, download the fixed share i/n of the jobs (e.g. 2/4) instead of claiming them')
+    parser.add_argument('course_names', nargs="*", metavar='<course name>',
                         type=str, help='one or more course names (from the url)')
     args = parser.parse_args()
 
+    if not args.course_names and not args.worker_dir:
+        parser.error("no course names given")
+    if args.worker_dir and args.pack:
+        # (the workers would write to the same zip files)
+        parser.error("--pack cannot be used with --worker")
+
     # check the parser
     parser = args.parser
     if parser == 'lxml' and not haslxml():
@@ -522,16 +1476,55 @@ def main():
 
     print "HTML parser set to %s" % parser
 
-    # prompt the user for his password if not specified
-    if not args.password:
+    # prompt the user for his password if not specified (with a cookie file
+    # that is only needed if the saved session has expired)
+    if not args.password and not args.cookie_file:
         args.password = getpass.getpass()
 
+    # the lecture resources to download
+    file_filter = None
+    if args.weeks or args.lecture_patterns or args.extensions or args.max_size is not None:
+        file_filter = Filter(args.weeks,args.lecture_patterns,args.extensions.split(',') if args.extensions else None,
+                             args.max_size*1024*1024 if args.max_size is not None else None)
+
     # instantiate the downloader class
-    d = CourseraDownloader(args.username,args.password,args.quiz,parser=parser)
+    d = CourseraDownloader(args.username,args.password,args.quiz,parser=parser,workers=args.workers,per_host=args.per_host,
+                           crawl_workers=args.crawl_workers,revalidate=args.revalidate,
+                           cache_ttl=args.cache_ttl,segments=args.segments,segment_threshold=args.segment_threshold*1024*1024,
+                           retries=args.retries,cookie_file=args.cookie_file,store_dir=args.store_dir,
+                           chunk_size=args.chunk_size*1024,archive_pages=args.archive_pages,pack=args.pack,
+                           pack_loose_size=args.pack_loose_size*1024*1024 if args.pack_loose_size is not None else None,
+                           keep_alive=args.keep_alive,file_filter=file_filter,order=args.order)
+
+    progress = ProgressBar(d.metrics).start() if args.progress else None
 
-    # download the content
-    for cn in args.course_names:
-        d.download_course(cn,dest_dir=args.dest_dir)
+    # download the content of all courses together
+    try:
+        if args.plan_file:
+            Planner(d,args.dest_dir).run(args.course_names,args.plan_file)
+        elif args.coordinate_dir:
+            Coordinator(d,args.dest_dir,args.coordinate_dir).run(args.course_names)
+        elif args.worker_dir:
+            Worker(d,args.dest_dir,args.worker_dir,args.shard).run()
+        elif args.watch:
+            Watcher(d,args.dest_dir,args.watch*60).run(args.course_names)
+        else:
+            Scheduler(d,args.dest_dir).run(args.course_names)
+    finally:
+        if progress:
+            progress.stop()
+        d.save_cookies()
+
+        extra = {'retries':d.controller.retried,'failures':len(d.controller.failures)}
+        if d.pool:
+            # (idle connections the server had closed)
+            extra['stale_connections'] = d.pool.stats()['stale']
+            d.pool.close()
+        d.controller.print_failures()
+        if args.metrics_file:
+            d.metrics.write_json(args.metrics_file,extra)
+        if args.prometheus_file:
+            d.metrics.write_prometheus(args.prometheus_file,extra)
 
 if __name__ == '__main__':
     main()
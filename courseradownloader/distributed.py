@@ -0,0 +1,194 @@
+"""
+Downloading of courses by several processes, possibly on several hosts that
+share the destination directory: a coordinator plans the courses into a job
+directory and the workers download their share of the jobs, each with its
+own session.
+"""
+import os
+import time
+import json
+import errno
+import socket
+import hashlib
+from pool import imap_unordered
+from scheduler import Job, JobOutput, Scheduler
+from writer import write_file
+
+class JobDir(object):
+    """The job directory: the plan (jobs.json, with the paths relative to the
+    destination directory so the hosts may mount it in different places),
+    a claims directory with a file per job taken by a worker and a done
+    directory with a file per finished job. Files are created with O_EXCL,
+    which is atomic on local and NFS (v3 and later) file systems."""
+
+    PLAN = "jobs.json"
+    CLAIMS = "claims"
+    DONE = "done"
+
+    def __init__(self,path):
+        self.path = path
+
+    def marker(self,kind,job):
+        return os.path.join(self.path,kind,str(job.id))
+
+    def write(self,course_names,jobs,dest_dir):
+        """Write the plan, starting afresh"""
+        for kind in (self.CLAIMS,self.DONE):
+            d = os.path.join(self.path,kind)
+            if not os.path.exists(d):
+                os.makedirs(d)
+            for fn in os.listdir(d):
+                os.remove(os.path.join(d,fn))
+
+        entries = []
+        for job in jobs:
+            e = job.to_dict()
+            e['target_dir'] = os.path.relpath(job.target_dir,dest_dir)
+            e['course_dir'] = os.path.relpath(job.course_dir,dest_dir)
+            entries.append(e)
+
+        # (the workers wait for it to appear)
+        write_file(os.path.join(self.path,self.PLAN),json.dumps({'courses':list(course_names),'jobs':entries}))
+
+    def read(self,dest_dir):
+        """Return the courses and jobs of the plan (with the paths in
+        dest_dir), or (None,None) if there is no plan yet"""
+        try:
+            with open(os.path.join(self.path,self.PLAN)) as f:
+                plan = json.load(f)
+        except IOError:
+            return None,None
+
+        jobs = []
+        for e in plan['jobs']:
+            job = Job.from_dict(e)
+            job.target_dir = os.path.normpath(os.path.join(dest_dir,job.target_dir))
+            job.course_dir = os.path.normpath(os.path.join(dest_dir,job.course_dir))
+            jobs.append(job)
+        return plan['courses'],jobs
+
+    def create(self,kind,job,owner=""):
+        """Create the marker of the job, returns False if it exists already"""
+        try:
+            fd = os.open(self.marker(kind,job),os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        os.write(fd,owner)
+        os.close(fd)
+        return True
+
+    def exists(self,kind,job):
+        return os.path.exists(self.marker(kind,job))
+
+    def remove(self,kind,job):
+        try:
+            os.remove(self.marker(kind,job))
+        except OSError:
+            pass
+
+class Coordinator(object):
+    """Plans the courses (like Scheduler does) and writes the jobs to the job
+    directory for the workers, without downloading anything itself"""
+
+    def __init__(self,downloader,dest_dir,job_dir):
+        self.downloader = downloader
+        self.dest_dir = dest_dir
+        self.jobs = JobDir(job_dir)
+
+    def run(self,course_names):
+        d = self.downloader
+        try:
+            jobs = []
+            for job in Scheduler(d,self.dest_dir).plan(course_names):
+                for l in job.notes:
+                    print l
+                if job.url:
+                    jobs.append(job)
+        finally:
+            d.close_manifests()
+
+        self.jobs.write(course_names,jobs,self.dest_dir)
+        print "* %d jobs written to %s, start the workers with --worker %s" % (len(jobs),self.jobs.path,self.jobs.path)
+        return jobs
+
+class Worker(object):
+    """Downloads a share of the jobs of the job directory to dest_dir, which
+    is the same directory for all the workers. With a shard (i,n) the share
+    is fixed: the jobs whose url hashes to i modulo n (i from 0). Without, the
+    workers take the jobs that are left one by one, by claiming them. A job
+    that fails is given up, so a worker run later can take it."""
+
+    # seconds between checks for the plan of the coordinator
+    POLL_INTERVAL = 5
+
+    def __init__(self,downloader,dest_dir,job_dir,shard=None,name=None):
+        self.downloader = downloader
+        self.dest_dir = dest_dir
+        self.jobs = JobDir(job_dir)
+        self.shard = shard
+        self.name = name or "%s:%d" % (socket.gethostname(),os.getpid())
+
+    def load(self,wait=True):
+        """Return the courses and jobs of the plan, waiting for it to appear"""
+        while True:
+            course_names,jobs = self.jobs.read(self.dest_dir)
+            if jobs is not None or not wait:
+                return course_names,jobs
+            print "* Waiting for the plan in " + self.jobs.path
+            time.sleep(self.POLL_INTERVAL)
+
+    def mine(self,job):
+        i,n = self.shard
+        return int(hashlib.md5(job.url.encode('utf-8')).hexdigest(),16) % n == i
+
+    def claimed(self,jobs):
+        """Generate the jobs this worker gets to run"""
+        for job in jobs:
+            if self.jobs.exists(JobDir.DONE,job):
+                continue
+            if self.shard:
+                if self.mine(job):
+                    yield job
+            elif self.jobs.create(JobDir.CLAIMS,job,self.name):
+                yield job
+
+    def run(self,wait=True):
+        """Download the share of the worker, returns the jobs it ran"""
+        course_names,jobs = self.load(wait)
+        if jobs is None:
+            return []
+
+        d = self.downloader
+        # (each worker has its own session)
+        for cname in course_names:
+            d.login(cname)
+
+        output = JobOutput(len(course_names) > 1)
+        ran = []
+        failed = 0
+        try:
+            for i,job,out in imap_unordered(lambda (i,job): (i,job,d.download_job(job)),enumerate(self.claimed(jobs)),d.workers):
+                output.add(i,job,out)
+
+                ran.append(job)
+                if job.ok:
+                    self.jobs.create(JobDir.DONE,job,self.name)
+                else:
+                    failed += 1
+                    if not self.shard:
+                        self.jobs.remove(JobDir.CLAIMS,job)
+        finally:
+            output.flush()
+            d.close_manifests()
+
+        print "* %s ran %d jobs, %d failed" % (self.name,len(ran),failed)
+        return ran
+
+def parse_shard(s):
+    """Parse a shard given as i/n, with i from 1 to n, returns (i-1,n)"""
+    i,n = [int(x) for x in s.split('/')]
+    if not 1 <= i <= n:
+        raise ValueError("shard %s out of range" % s)
+    return i - 1,n
@@ -0,0 +1,138 @@
+"""
+Extraction of the few bits of information the downloader needs from the
+coursera pages (lecture index, lecture iframes, quiz/assignment lists, ...).
+
+With lxml available these are evaluated as XPath expressions on a plain lxml
+tree, which is considerably faster and lighter than building a BeautifulSoup
+tree for the whole page. Otherwise, or if another parser is chosen, the pages
+are parsed with BeautifulSoup, limited to the relevant parts where possible.
+"""
+from bs4 import BeautifulSoup, SoupStrainer, UnicodeDammit
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+def _cls(name):
+    """XPath predicate matching elements that have the given css class"""
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+def _has_class(name):
+    """SoupStrainer attribute filter matching elements that have the given css
+    class (while parsing, the class attribute is not split into a list yet)"""
+    def match(value):
+        if value is None:
+            return False
+        values = value if isinstance(value,list) else value.split()
+        return name in values
+    return match
+
+class Extractor(object):
+    """Extracts data from coursera pages, using lxml XPath if the html parser
+    is lxml and it is available, or BeautifulSoup with the given parser"""
+
+    def __init__(self,parser="lxml"):
+        self.parser = parser
+        self.use_lxml = parser == "lxml" and lxml is not None
+
+    def tree(self,page):
+        if hasattr(page,'read'):
+            page = page.read()
+        if isinstance(page,unicode):
+            return lxml.html.fromstring(page)
+
+        # lxml only looks at a <meta charset> and takes pages without one as
+        # latin-1, so the encoding is detected the way BeautifulSoup does it
+        encoding = UnicodeDammit(page,is_html=True).original_encoding
+        return lxml.html.fromstring(page,parser=lxml.html.HTMLParser(encoding=encoding))
+
+    def soup(self,page,strainer=None):
+        if self.parser == "html5lib":
+            # html5lib always builds the complete tree (and warns about it), so
+            # the lookups on the result repeat what the strainer selects
+            strainer = None
+        return BeautifulSoup(page,self.parser,parse_only=strainer)
+
+    def lecture_index(self,page):
+        """Return the weeks of the lecture index page as a list of (title,
+        lectures), each lecture a (title, resource urls, iframe url or None)
+        tuple, in the order they appear"""
+        weeks = []
+
+        if self.use_lxml:
+            root = self.tree(page)
+            for header in root.xpath("//div[%s]" % _cls("course-item-list-header")):
+                h3 = header.xpath("(descendant::h3 | following::h3)[1]")[0]
+                lectures = []
+                for li in header.getnext().iter('li'):
+                    iframe = li.xpath("(.//a[%s])[1]/@data-modal-iframe" % _cls("lecture-link"))
+                    res = li.xpath("(.//div[%s])[1]//a/@href" % _cls("course-lecture-item-resource"))
+                    lectures.append((li.xpath("(.//a)[1]")[0].text_content(),res,iframe[0] if iframe else None))
+                weeks.append((h3.text_content(),lectures))
+            return weeks
+
+        # the weeks are found through their siblings, so this needs the full tree
+        soup = self.soup(page)
+        for header in soup.findAll("div", { "class" : "course-item-list-header" }):
+            h3 = header.findNext('h3')
+            lectures = []
+            for li in header.next_sibling.findAll('li'):
+                ll = li.find('a',{'class':'lecture-link'})
+                res = li.find('div', {'class':'course-lecture-item-resource'})
+                lectures.append((li.a.text,[h['href'] for h in res.findAll('a')],ll.get('data-modal-iframe') if ll else None))
+            weeks.append((h3.text,lectures))
+        return weeks
+
+    def iframe_video(self,page):
+        """Return the url of the mp4 video of a lecture iframe page, or None"""
+        if self.use_lxml:
+            src = self.tree(page).xpath("//source[@type='video/mp4']/@src")
+            return src[0] if src else None
+
+        vobj = self.soup(page,SoupStrainer('source',type="video/mp4")).find('source',type="video/mp4")
+        return vobj['src'] if vobj else None
+
+    def item_list(self,page):
+        """Return the (url,title) of the items on a quiz or assignment list page"""
+        if self.use_lxml:
+            qlist = self.tree(page).xpath("(//div[%s])[1]" % _cls("course-item-list"))[0]
+            qurls = qlist.xpath(".//a[%s]/@href" % _cls("btn-primary"))
+            titles = [t.text_content() for t in qlist.iter('h4')]
+            return zip(qurls,titles)
+
+        qlist = self.soup(page,SoupStrainer('div',{'class':_has_class('course-item-list')})).find('div',{'class':'course-item-list'})
+        qurls = [q['href'] for q in qlist.findAll('a',{'class':'btn-primary'})]
+        titles = [t.string for t in qlist.find_all('h4')]
+        return zip(qurls,titles)
+
+    def navbar_links(self,page):
+        """Return the urls linked from the course navigation bar"""
+        if self.use_lxml:
+            return self.tree(page).xpath("(//ul[%s])[1]//a/@href" % _cls("course-navbar-list"))
+
+        qlist = self.soup(page,SoupStrainer('ul',{'class':_has_class('course-navbar-list')})).find('ul',{'class':'course-navbar-list'})
+        return [q['href'] for q in qlist.findAll('a')]
+
+    def has_login_form(self,page):
+        """True if the page has the password field of the login form"""
+        if self.use_lxml:
+            return bool(self.tree(page).xpath("//input[@id='password_login']"))
+
+        return bool(self.soup(page,SoupStrainer('input',{'id':'password_login'})).find('input',{'id':'password_login'}))
+
+    def has_quiz_start_form(self,page):
+        """True if the page is the start page of a quiz rather than the quiz itself"""
+        if self.use_lxml:
+            return bool(self.tree(page).xpath("//form[%s]" % _cls("course-quiz-start-form")))
+
+        return bool(self.soup(page,SoupStrainer('form',{'class':_has_class('course-quiz-start-form')})).find('form',{'class':'course-quiz-start-form'}))
+
+    def title(self,page):
+        """Return the title of the page (or an empty string)"""
+        if self.use_lxml:
+            t = self.tree(page).find('.//title')
+            return t.text_content() if t is not None else ''
+
+        t = self.soup(page,SoupStrainer('title')).find('title')
+        return t.string if t else ''
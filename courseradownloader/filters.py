@@ -0,0 +1,55 @@
+"""
+Selection of the lecture resources to download, by week, lecture name, file
+type and size, so part of a course can be synced without the rest of it.
+"""
+import os
+import re
+import urlparse
+
+class Filter(object):
+    """Which lecture resources to download: those of the given weeks (numbered
+    from 1, as the week directories are), of the lectures whose name matches
+    one of the patterns (regular expressions, case insensitive), with one of
+    the extensions and of at most max_size bytes. What is not given is not
+    filtered on."""
+
+    def __init__(self,weeks=None,lectures=None,extensions=None,max_size=None):
+        self.weeks = set(weeks) if weeks else None
+        self.lectures = [re.compile(p,re.I) for p in lectures] if lectures else None
+        self.extensions = set(e.lower().lstrip('.') for e in extensions) if extensions else None
+        self.max_size = max_size
+
+    def week(self,n):
+        return self.weeks is None or n in self.weeks
+
+    def lecture(self,name):
+        return self.lectures is None or any(p.search(name) for p in self.lectures)
+
+    def file(self,filename,size=-1):
+        """Return why the file is left out ('type' or 'size'), or None to
+        download it. A file of unknown name (None) or size (-1) is let
+        through, to be checked again once the response headers tell."""
+        if self.extensions is not None and filename:
+            ext = os.path.splitext(filename)[1].lower().lstrip('.')
+            if ext not in self.extensions:
+                return 'type'
+        if self.max_size is not None and size > self.max_size:
+            return 'size'
+        return None
+
+def resource_name(url,target_fname=None):
+    """Return the file name of a lecture resource as far as it is known before
+    requesting it (the given one, or the last part of the url path if it has
+    an extension), or None"""
+    if target_fname:
+        return target_fname
+    name = urlparse.urlparse(url).path.rsplit('/',1)[-1]
+    return name if os.path.splitext(name)[1] else None
+
+def parse_weeks(s):
+    """Parse a list of weeks and ranges of weeks, e.g. 1,3-5"""
+    weeks = set()
+    for part in s.split(','):
+        first,_,last = part.strip().partition('-')
+        weeks.update(range(int(first),int(last or first) + 1))
+    return weeks
@@ -0,0 +1,93 @@
+"""
+Per course record of the files that were downloaded completely, so later runs
+can skip them without having to trust the Content-Length of the server.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+class Manifest(object):
+    """SQLite database in the course directory holding the url, path (relative
+    to the course directory), size, ETag/Last-Modified and sha1 checksum of
+    every completed download"""
+
+    FILENAME = ".coursera-dl.sqlite"
+
+    def __init__(self,course_dir):
+        self.course_dir = course_dir
+        self.path = os.path.join(course_dir,self.FILENAME)
+
+        # the connection is shared by the download threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path,check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                                url TEXT PRIMARY KEY,
+                                path TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                etag TEXT,
+                                last_modified TEXT,
+                                sha1 TEXT,
+                                completed REAL)""")
+            self.db.commit()
+
+    def get(self,url):
+        """Return the entry for the url (a dict), or None"""
+        with self.lock:
+            row = self.db.execute("SELECT * FROM files WHERE url = ?",(url,)).fetchone()
+        if not row:
+            return None
+
+        entry = dict(zip(row.keys(),row))
+        entry['filepath'] = os.path.join(self.course_dir,entry['path'])
+        return entry
+
+    def add(self,url,filepath,size,etag=None,last_modified=None,sha1=None):
+        """Record that url was completely downloaded to filepath"""
+        path = os.path.relpath(filepath,self.course_dir)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)",
+                            (url,path,size,etag,last_modified,sha1,time.time()))
+            self.db.commit()
+
+    def remove(self,url):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE url = ?",(url,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def is_complete(entry):
+        """True if the file of the entry is still on disk with the recorded size"""
+        fp = entry['filepath']
+        return os.path.isfile(fp) and os.path.getsize(fp) == entry['size']
+
+    @staticmethod
+    def conditional_headers(entry):
+        """The request headers to check whether the entry is still up to date
+        (the server replies with a 304 if so)"""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+def file_sha1(filepath,limit=None,chunk_size=64*1024):
+    """Return a sha1 object over the contents of the file (or its first limit bytes)"""
+    h = hashlib.sha1()
+    left = os.path.getsize(filepath) if limit is None else limit
+    with open(filepath,'rb') as f:
+        while left > 0:
+            block = f.read(min(chunk_size,left))
+            if not block:
+                break
+            h.update(block)
+            left -= len(block)
+    return h
@@ -0,0 +1,238 @@
+"""
+Timing and throughput of a run, per phase (login, crawling, iframe lookups,
+downloads, ...), exported as a json summary or a Prometheus text file, and an
+optional progress line showing the download rate.
+"""
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from mechanize import BaseHandler
+from writer import write_file
+
+class Metrics(object):
+    """Counts the requests, their latency (up to the response headers) and
+    status codes, the bytes written and the time spent per phase. The phase
+    is that of the calling thread, see phase."""
+
+    # upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.phases = {}
+        self.bytes = 0
+        self.files = 0
+
+    def get(self,name):
+        """Return the counters of the phase (the lock must be held)"""
+        if name not in self.phases:
+            self.phases[name] = {'calls':0,'seconds':0.0,'first':None,'last':None,
+                                 'requests':0,'codes':{},'latency':[0] * (len(self.BUCKETS) + 1),
+                                 'latency_sum':0.0,'bytes':0,'files':0,'connections':0,'reused':0}
+        return self.phases[name]
+
+    def current(self):
+        return getattr(self.local,'phase',None) or 'other'
+
+    @contextmanager
+    def phase(self,name,count=True):
+        """Attribute what the calling thread does meanwhile to the phase. The
+        time of a phase is both summed over its calls (which may run in
+        parallel) and measured from its first start to its last end. Without
+        count the time is added to the phase as part of an earlier call
+        (e.g. the rest of a call that returned a generator), unless the
+        calling thread is in the phase already."""
+        prev = getattr(self.local,'phase',None)
+        if not count and prev == name:
+            yield
+            return
+
+        self.local.phase = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.local.phase = prev
+            end = time.time()
+            with self.lock:
+                p = self.get(name)
+                if count:
+                    p['calls'] += 1
+                p['seconds'] += end - start
+                p['first'] = start if p['first'] is None else min(p['first'],start)
+                p['last'] = end if p['last'] is None else max(p['last'],end)
+
+    @contextmanager
+    def attribute(self,name):
+        """Attribute what the calling thread does meanwhile to the phase,
+        without counting it as a call of the phase, e.g. the work a call
+        hands to other threads (pass them the phase of the call)"""
+        prev = getattr(self.local,'phase',None)
+        self.local.phase = name
+        try:
+            yield
+        finally:
+            self.local.phase = prev
+
+    def request(self,seconds,code):
+        with self.lock:
+            p = self.get(self.current())
+            p['requests'] += 1
+            p['codes'][code] = p['codes'].get(code,0) + 1
+            p['latency_sum'] += seconds
+            i = 0
+            while i < len(self.BUCKETS) and seconds > self.BUCKETS[i]:
+                i += 1
+            p['latency'][i] += 1
+
+    def connection(self,reused):
+        """Count a connection taken for a request, new or reused (see
+        ConnectionPool)"""
+        with self.lock:
+            p = self.get(self.current())
+            p['reused' if reused else 'connections'] += 1
+
+    def add_bytes(self,n):
+        with self.lock:
+            self.get(self.current())['bytes'] += n
+            self.bytes += n
+
+    def add_file(self):
+        with self.lock:
+            self.get(self.current())['files'] += 1
+            self.files += 1
+
+    def summary(self):
+        """Return the metrics as a dict (what write_json writes)"""
+        with self.lock:
+            elapsed = time.time() - self.started
+            phases = {}
+            for name,p in self.phases.items():
+                wall = p['last'] - p['first'] if p['first'] is not None else 0.0
+                phases[name] = {'calls':p['calls'],'seconds':round(p['seconds'],3),'wall_seconds':round(wall,3),
+                                'requests':p['requests'],'status_codes':dict((str(c),n) for c,n in p['codes'].items()),
+                                'latency_buckets':dict(zip([str(b) for b in self.BUCKETS] + ['+Inf'],p['latency'])),
+                                'latency_seconds_total':round(p['latency_sum'],3),
+                                'bytes':p['bytes'],'files':p['files'],
+                                'connections_opened':p['connections'],'connections_reused':p['reused']}
+            return {'elapsed_seconds':round(elapsed,3),'bytes':self.bytes,'files':self.files,
+                    'bytes_per_second':round(self.bytes / elapsed,1) if elapsed else 0.0,
+                    'phases':phases}
+
+    def write_json(self,filename,extra=None):
+        s = self.summary()
+        s.update(extra or {})
+        write_file(filename,json.dumps(s,indent=2,sort_keys=True))
+
+    def write_prometheus(self,filename,extra=None):
+        """Write the metrics in the Prometheus text format (e.g. for the
+        textfile collector of the node exporter), extra counters can be given
+        as a dict of name: value"""
+        s = self.summary()
+        out = []
+
+        def metric(name,kind,help,samples):
+            out.append("# HELP coursera_dl_%s %s" % (name,help))
+            out.append("# TYPE coursera_dl_%s %s" % (name,kind))
+            for labels,value in samples:
+                l = ",".join('%s="%s"' % kv for kv in labels)
+                out.append("coursera_dl_%s%s %s" % (name,"{%s}" % l if l else "",value))
+
+        phases = sorted(s['phases'].items())
+        metric("phase_seconds","gauge","Time spent in the phase, summed over parallel calls",
+               [((('phase',n),),p['seconds']) for n,p in phases])
+        metric("phase_wall_seconds","gauge","Time from the first start to the last end of the phase",
+               [((('phase',n),),p['wall_seconds']) for n,p in phases])
+        metric("requests_total","counter","Requests made, by phase and status code",
+               [((('phase',n),('code',c)),v) for n,p in phases for c,v in sorted(p['status_codes'].items())])
+
+        out.append("# HELP coursera_dl_request_latency_seconds Time until the response headers arrived")
+        out.append("# TYPE coursera_dl_request_latency_seconds histogram")
+        for n,p in phases:
+            total = 0
+            for b in [str(b) for b in self.BUCKETS] + ['+Inf']:
+                total += p['latency_buckets'][b]
+                out.append('coursera_dl_request_latency_seconds_bucket{phase="%s",le="%s"} %d' % (n,b,total))
+            out.append('coursera_dl_request_latency_seconds_sum{phase="%s"} %s' % (n,p['latency_seconds_total']))
+            out.append('coursera_dl_request_latency_seconds_count{phase="%s"} %d' % (n,p['requests']))
+
+        metric("bytes_total","counter","Bytes downloaded, by phase",[((('phase',n),),p['bytes']) for n,p in phases])
+        metric("files_total","counter","Files downloaded, by phase",[((('phase',n),),p['files']) for n,p in phases])
+        metric("connections_total","counter","Connections used for requests, by phase and whether they were reused",
+               [((('phase',n),('reused',r)),p[k]) for n,p in phases
+                for r,k in (('false','connections_opened'),('true','connections_reused'))])
+        metric("elapsed_seconds","gauge","Duration of the run",[((),s['elapsed_seconds'])])
+        for name,value in sorted((extra or {}).items()):
+            metric(name,"counter",name.replace("_"," ").capitalize(),[((),value)])
+
+        write_file(filename,"\n".join(out) + "\n")
+
+def timed(name):
+    """Decorator for methods of an object with a metrics attribute, which
+    runs them in the given phase"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(self,*args,**kwargs):
+            with self.metrics.phase(name):
+                return fn(self,*args,**kwargs)
+        return wrapper
+    return decorate
+
+class MetricsHandler(BaseHandler):
+    """mechanize handler reporting the latency and status code of every
+    request to the metrics (it runs before error responses are raised)"""
+
+    handler_order = 900
+
+    def __init__(self,metrics):
+        self.metrics = metrics
+
+    def http_request(self,request):
+        request.metrics_start = time.time()
+        return request
+
+    def http_response(self,request,response):
+        start = getattr(request,'metrics_start',None)
+        if start is not None:
+            self.metrics.request(time.time() - start,response.code)
+        return response
+
+    https_request = http_request
+    https_response = http_response
+
+class ProgressBar(object):
+    """Shows the number of files and bytes downloaded and the current rate on
+    a single line (of stderr), until stopped"""
+
+    def __init__(self,metrics,interval=0.5,stream=sys.stderr):
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.stream.write("\n")
+
+    def run(self):
+        # the rate over the last few seconds
+        window = [(time.time(),0)]
+        while not self.stopped.wait(self.interval):
+            now,nbytes = time.time(),self.metrics.bytes
+            window = window[-int(5 / self.interval):] + [(now,nbytes)]
+            rate = (nbytes - window[0][1]) / (now - window[0][0]) if now > window[0][0] else 0
+            # (the line is rewritten in place, output printed meanwhile overwrites it)
+            self.stream.write("\r[%d files, %.1f MB, %.2f MB/s]\r" % (self.metrics.files,nbytes / 1048576.0,rate / 1048576.0))
+            self.stream.flush()
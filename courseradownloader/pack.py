@@ -0,0 +1,74 @@
+"""
+Packed output: the files of a course kept in a single zip file rather than in
+hundreds of small files, which is kinder to backups and rsync.
+"""
+import os
+import zipfile
+import threading
+from writer import replace
+
+class Pack(object):
+    """Zip file in the course directory holding the downloaded files under
+    their path relative to the course directory (so with the usual week and
+    lecture directories). Text is compressed, other files (videos, pdfs) are
+    stored as they are. Files of at least loose_size bytes are left out of
+    the pack."""
+
+    FILENAME = "content.zip"
+
+    # the files that are worth compressing
+    TEXT = ('.html','.htm','.txt','.srt','.vtt','.css','.js','.json','.xml','.svg','.csv','.md','.tex')
+
+    def __init__(self,course_dir,loose_size=None):
+        self.course_dir = course_dir
+        self.path = os.path.join(course_dir,self.FILENAME)
+        self.loose_size = loose_size
+
+        # (zip files cannot be written by several threads at once)
+        self.lock = threading.Lock()
+        self.members = set()
+        if os.path.exists(self.path):
+            with zipfile.ZipFile(self.path) as z:
+                self.members = set(z.namelist())
+
+    def member(self,filepath):
+        return os.path.relpath(filepath,self.course_dir).replace(os.sep,'/')
+
+    def has(self,filepath):
+        with self.lock:
+            return self.member(filepath) in self.members
+
+    def add(self,filepath):
+        """Move the file into the pack, unless it is to stay loose. Returns
+        whether it was packed."""
+        if self.loose_size is not None and os.path.getsize(filepath) >= self.loose_size:
+            return False
+
+        name = self.member(filepath)
+        compress = zipfile.ZIP_DEFLATED if os.path.splitext(name)[1].lower() in self.TEXT else zipfile.ZIP_STORED
+
+        with self.lock:
+            if name in self.members:
+                # a file that changed replaces the old one, rather than
+                # growing the pack with another member of the same name
+                self.remove(name)
+
+            # the zip is closed after every file, so an interruption loses at
+            # most the file being added rather than the index of the pack
+            with zipfile.ZipFile(self.path,'a' if os.path.exists(self.path) else 'w',allowZip64=True) as z:
+                z.write(filepath,name,compress)
+            self.members.add(name)
+
+        os.remove(filepath)
+        return True
+
+    def remove(self,name):
+        """Rewrite the pack without the member (the lock must be held)"""
+        tmp = self.path + ".tmp"
+        with zipfile.ZipFile(self.path) as src:
+            with zipfile.ZipFile(tmp,'w',allowZip64=True) as dst:
+                for info in src.infolist():
+                    if info.filename != name:
+                        dst.writestr(info,src.read(info))
+        replace(tmp,self.path)
+        self.members.discard(name)
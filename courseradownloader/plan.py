@@ -0,0 +1,71 @@
+"""
+Dry run of a download: the files of the courses, their sizes (from HEAD
+requests) and whether they still need to be downloaded, without downloading
+anything.
+"""
+import csv
+import json
+from pool import imap_ordered
+
+class Planner(object):
+    """Plans the courses like Scheduler does and looks up every job in
+    parallel with CourseraDownloader.plan_job. The plan is written as json (a
+    list of entries) or, for a .csv file name, as csv."""
+
+    FIELDS = ('course','kind','url','path','size','status','error')
+
+    def __init__(self,downloader,dest_dir="."):
+        self.downloader = downloader
+        self.dest_dir = dest_dir
+
+    def plan(self,course_names):
+        """Return the entries (see CourseraDownloader.plan_job) of all the
+        files of the courses, in course order"""
+        d = self.downloader
+        jobs = []
+        for cname in course_names:
+            jobs += [j for j in d.plan_course(cname,self.dest_dir,create_dirs=False) if j.url]
+
+        # (HEAD requests are as light as those of the crawl)
+        try:
+            return list(imap_ordered(d.plan_job,jobs,max(d.workers,d.crawl_workers)))
+        finally:
+            d.close_manifests()
+
+    def write(self,entries,filename):
+        if filename.lower().endswith(".csv"):
+            with open(filename,'wb') as f:
+                w = csv.DictWriter(f,self.FIELDS)
+                w.writeheader()
+                for e in entries:
+                    w.writerow(dict((k,v.encode('utf-8') if isinstance(v,unicode) else v) for k,v in e.items()))
+        else:
+            with open(filename,'w') as f:
+                json.dump(entries,f,indent=2)
+
+    def run(self,course_names,filename):
+        entries = self.plan(course_names)
+        self.write(entries,filename)
+
+        todo = [e for e in entries if e['status'] == 'needs-download']
+        unknown = len([e for e in todo if e['size'] is None])
+        print "* %d files, %d present, %d in the store, %d to download (%s%s)" % (
+            len(entries),
+            len([e for e in entries if e['status'] == 'present']),
+            len([e for e in entries if e['status'] == 'in-store']),
+            len(todo),
+            formatSize(sum(e['size'] or 0 for e in todo)),
+            ", %d of unknown size" % unknown if unknown else "")
+        filtered = len([e for e in entries if e['status'] == 'filtered'])
+        if filtered:
+            print "* %d files left out by the filters" % filtered
+        errors = len([e for e in entries if e['status'] == 'error'])
+        if errors:
+            print "* %d files could not be looked up" % errors
+        print "* The plan was written to " + filename
+
+def formatSize(size):
+    for unit in ('bytes','KB','MB','GB'):
+        if size < 1024 or unit == 'GB':
+            return ("%d %s" if unit == 'bytes' else "%.1f %s") % (size,unit)
+        size /= 1024.0
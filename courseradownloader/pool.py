@@ -0,0 +1,229 @@
+"""
+Small threading helpers used to run downloads (and other network bound work)
+concurrently.
+"""
+import sys
+import Queue
+import threading
+import urlparse
+from contextlib import contextmanager
+
+def imap_ordered(func, iterable, workers, backlog=None):
+    """Like itertools.imap, but func is applied on up to `workers` threads.
+
+    Results are yielded in the order of the input. The input is consumed lazily
+    and at most `backlog` (defaults to 2 * workers) items are in flight at any
+    time, so it may be a (slow) generator. An exception raised by func is
+    re-raised when its result is due."""
+
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    backlog = backlog or 2 * workers
+    slots = threading.Semaphore(backlog)
+    cond = threading.Condition()
+    state = {'todo': [], 'done': {}, 'total': None, 'error': None, 'stop': False}
+
+    def feeder():
+        n = 0
+        try:
+            for item in iterable:
+                slots.acquire()
+                with cond:
+                    if state['stop']:
+                        return
+                    state['todo'].append((n, item))
+                    cond.notify_all()
+                n += 1
+        except Exception:
+            with cond:
+                state['error'] = sys.exc_info()
+        finally:
+            with cond:
+                state['total'] = n
+                cond.notify_all()
+
+    def worker():
+        while True:
+            with cond:
+                while not state['todo'] and state['total'] is None and not state['stop']:
+                    cond.wait(0.5)
+                if state['stop'] or not state['todo']:
+                    return
+                i, item = state['todo'].pop(0)
+            try:
+                res = (True, func(item))
+            except BaseException:
+                res = (False, sys.exc_info())
+            with cond:
+                state['done'][i] = res
+                cond.notify_all()
+
+    threads = [threading.Thread(target=feeder)]
+    threads += [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        i = 0
+        while True:
+            with cond:
+                # (wait with a timeout so a KeyboardInterrupt still gets through)
+                while i not in state['done'] and not (state['total'] == i or state['error']):
+                    cond.wait(0.5)
+                if i not in state['done']:
+                    break
+                ok, res = state['done'].pop(i)
+            slots.release()
+            if not ok:
+                raise res[0], res[1], res[2]
+            yield res
+            i += 1
+
+        if state['error']:
+            err = state['error']
+            raise err[0], err[1], err[2]
+    finally:
+        with cond:
+            state['stop'] = True
+            cond.notify_all()
+        # unblock the feeder if it is waiting for a slot
+        slots.release()
+
+def imap_unordered(func, items, workers, backlog=None):
+    """Like imap_ordered, but the results are yielded as soon as they are
+    available. The items are picked up by the workers in the given order,
+    and like imap_ordered the input is consumed lazily, with at most
+    `backlog` (defaults to 2 * workers) items waiting for a worker."""
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    backlog = backlog or 2 * workers
+    todo = Queue.Queue(backlog)
+    results = Queue.Queue()
+    stop = threading.Event()
+    state = {'total': None, 'error': None}
+
+    def put(q, item):
+        # (gives up once the consumer is gone)
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def feeder():
+        n = 0
+        try:
+            for item in items:
+                if not put(todo, (True, item)):
+                    return
+                n += 1
+        except Exception:
+            state['error'] = sys.exc_info()
+        finally:
+            state['total'] = n
+            # one end marker per worker
+            for _ in range(workers):
+                put(todo, (False, None))
+            results.put(None)
+
+    def worker():
+        while not stop.is_set():
+            try:
+                more, item = todo.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if not more:
+                return
+            try:
+                results.put((True, func(item)))
+            except BaseException:
+                results.put((False, sys.exc_info()))
+
+    threads = [threading.Thread(target=feeder)]
+    threads += [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        n = 0
+        fed = False
+        while not fed or n < state['total']:
+            # (wait with a timeout so a KeyboardInterrupt still gets through)
+            try:
+                res = results.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if res is None:
+                # the feeder is done, state['total'] is set
+                fed = True
+                continue
+            ok, res = res
+            n += 1
+            if not ok:
+                raise res[0], res[1], res[2]
+            yield res
+
+        if state['error']:
+            err = state['error']
+            raise err[0], err[1], err[2]
+    finally:
+        stop.set()
+
+class HostLimiter(object):
+    """Caps the number of concurrent requests to a single host"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def semaphore(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.limit)
+            return self.hosts[host]
+
+    @contextmanager
+    def slot(self, url):
+        """Blocks until a request to the host of url may be made"""
+        if self.limit <= 0:
+            yield
+            return
+
+        sem = self.semaphore(url)
+        sem.acquire()
+        try:
+            yield
+        finally:
+            sem.release()
+
+    @contextmanager
+    def extra(self, url, n):
+        """Takes up to n more slots for the host of url, as many as are free
+        right away, for a request that holds one already and can spread
+        over more connections. Yields the number taken."""
+        if self.limit <= 0:
+            yield n
+            return
+
+        sem = self.semaphore(url)
+        taken = 0
+        while taken < n and sem.acquire(False):
+            taken += 1
+        try:
+            yield taken
+        finally:
+            for _ in range(taken):
+                sem.release()
@@ -0,0 +1,181 @@
+"""
+Retrying of failed requests with exponential backoff, and adaptive (AIMD)
+limiting of the number of concurrent requests per host.
+"""
+import time
+import random
+import socket
+import httplib
+import threading
+import urlparse
+from contextlib import contextmanager
+from email.utils import parsedate_tz, mktime_tz
+from mechanize import HTTPError
+
+class AIMDLimiter(object):
+    """Limits the number of concurrent requests: the limit goes up by one for
+    every limit successful requests (additive increase) and is halved when the
+    server signals it is overloaded (multiplicative decrease), at most once
+    per cooldown seconds so a burst of errors counts once"""
+
+    def __init__(self,maximum,minimum=1,cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.active = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait(0.5)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify_all()
+
+    @contextmanager
+    def extra(self,n):
+        """Takes up to n more slots, as many as the limit leaves free right
+        away, for a request that holds one already and can spread over more
+        connections. Yields the number taken."""
+        with self.cond:
+            taken = max(0,min(n,int(self.limit) - self.active))
+            self.active += taken
+        try:
+            yield taken
+        finally:
+            with self.cond:
+                self.active -= taken
+                self.cond.notify_all()
+
+    def success(self):
+        with self.cond:
+            self.limit = min(self.maximum,self.limit + 1.0/self.limit)
+            self.cond.notify_all()
+
+    def overloaded(self):
+        with self.cond:
+            now = time.time()
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(self.minimum,self.limit / 2)
+                self.last_decrease = now
+
+@contextmanager
+def _no_slot():
+    yield
+
+class RequestController(object):
+    """Runs requests, retrying those that fail because of a network error or
+    a 429/5xx response with exponential backoff and jitter (or after the time
+    given by Retry-After). The urls that keep failing are remembered."""
+
+    RETRY_CODES = (408,429,500,502,503,504)
+
+    # codes that mean the server wants us to slow down
+    OVERLOAD_CODES = (429,503)
+
+    def __init__(self,retries=5,backoff=1.0,max_backoff=60.0,max_concurrency=8):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+
+        self.lock = threading.Lock()
+        self.limiters = {}
+        self.failures = []
+        self.retried = 0
+
+    def limiter(self,url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = AIMDLimiter(self.max_concurrency)
+            return self.limiters[host]
+
+    def call(self,fn,url,nested=False):
+        """Return fn(), the request for url. Errors that are not worth
+        retrying, or still occur after the last retry, are raised. A nested
+        call is made within a call for the same url (the segments of a
+        download): it runs on the slots of the outer call (see extra) rather
+        than taking one of its own, and its failure is left to the outer
+        call to record."""
+        limiter = self.limiter(url)
+        slot = _no_slot if nested else limiter.slot
+
+        for attempt in range(self.retries + 1):
+            with slot():
+                try:
+                    res = fn()
+                    limiter.success()
+                    return res
+                except Exception as e:
+                    delay = self.retry_delay(e,attempt)
+                    if delay is None or attempt == self.retries:
+                        if not nested:
+                            self.failed(url,e)
+                        raise
+                    if isinstance(e,HTTPError) and e.code in self.OVERLOAD_CODES:
+                        limiter.overloaded()
+
+            with self.lock:
+                self.retried += 1
+            time.sleep(delay)
+
+    def extra(self,url,n):
+        """Take up to n more concurrency slots for the host of url, for a
+        call that spreads over several connections (see AIMDLimiter.extra)"""
+        return self.limiter(url).extra(n)
+
+    def retry_delay(self,e,attempt):
+        """Return the number of seconds to wait before retrying after the
+        error, or None if it should not be retried"""
+        if isinstance(e,HTTPError):
+            if e.code not in self.RETRY_CODES:
+                return None
+            after = parseRetryAfter(e.info().get('Retry-After')) if e.info() else None
+        elif isinstance(e,(IOError,socket.error,httplib.HTTPException)):
+            # a network error rather than a problem with a local file
+            if getattr(e,'filename',None):
+                return None
+            after = None
+        else:
+            return None
+
+        delay = random.uniform(0,min(self.max_backoff,self.backoff * 2 ** attempt))
+        return max(delay,after) if after is not None else delay
+
+    def failed(self,url,e):
+        # (304s etc. are answers, not failures)
+        if isinstance(e,HTTPError) and e.code < 400:
+            return
+        with self.lock:
+            self.failures.append((url,e))
+
+    def print_failures(self):
+        """Print (and forget) the urls that could not be downloaded"""
+        with self.lock:
+            failures,self.failures = self.failures,[]
+
+        if failures:
+            print "* The following %d urls could not be downloaded:" % len(failures)
+            for url,e in failures:
+                print "  - %s: %s" % (url,e)
+
+def parseRetryAfter(value):
+    """Return the number of seconds of a Retry-After header (which is either
+    a number of seconds or a date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0,int(value))
+    except ValueError:
+        pass
+    t = parsedate_tz(value)
+    return max(0,mktime_tz(t) - time.time()) if t else None
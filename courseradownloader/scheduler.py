@@ -0,0 +1,231 @@
+"""
+Downloading of several courses through one shared queue of jobs, so that a
+slow course does not hold up the others, with the state of the run kept on disk
+so an interrupted run continues where it stopped.
+"""
+import os
+import json
+from pool import imap_unordered
+from writer import write_file
+
+class Job(object):
+    """A single download: the url and where it goes. The kind says how it is
+    fetched (see CourseraDownloader.download_job) and is one of 'page',
+    'file' (a lecture resource, recorded in the course manifest),
+    'assignment' or 'quiz'. Lines are the progress lines printed with it,
+    notes the messages logged while it was planned (which are not saved)."""
+
+    FIELDS = ('id','course','kind','url','target_dir','target_fname','course_dir','priority','lines')
+
+    def __init__(self,course,kind,url,target_dir,target_fname=None,course_dir=None,priority=0,lines=None,id=None):
+        self.id = id
+        self.course = course
+        self.kind = kind
+        self.url = url
+        self.target_dir = target_dir
+        self.target_fname = target_fname
+        self.course_dir = course_dir or target_dir
+        self.priority = priority
+        self.lines = lines or []
+        self.notes = []
+        self.ok = None
+
+    def to_dict(self):
+        return dict((f,getattr(self,f)) for f in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls,d):
+        return cls(**dict((str(k),v) for k,v in d.items()))
+
+    def __repr__(self):
+        return "<Job %s %s %s>" % (self.id,self.kind,self.url)
+
+class JobOutput(object):
+    """Prints the output of the jobs in the order they were handed out
+    (numbered from 0) rather than the order they finish in, so the week and
+    lecture lines, which come with the first job of each, stay above their
+    files. With prefix each line starts with the course of the job."""
+
+    def __init__(self,prefix=False):
+        self.prefix = prefix
+        self.next = 0
+        self.pending = {}
+
+    def add(self,i,job,out):
+        self.pending[i] = (job,out)
+        while self.next in self.pending:
+            self.write(*self.pending.pop(self.next))
+            self.next += 1
+
+    def flush(self):
+        """Print what is held back (for jobs that are still running)"""
+        for i in sorted(self.pending):
+            self.write(*self.pending.pop(i))
+
+    def write(self,job,out):
+        for l in out:
+            print ("[%s] %s" % (job.course,l)) if self.prefix else l
+
+class Scheduler(object):
+    """Plans the courses and downloads all their jobs with the workers of the
+    downloader. The n-th job of every course comes in turn, so the courses
+    progress side by side rather than one after the other. The downloads
+    start as soon as the first jobs are planned, while the lectures of the
+    courses are still being looked up.
+
+    The plan (written as it grows) and the ids of the finished jobs are kept
+    in the destination directory until every job has been tried. Running
+    again for the same courses after an interruption continues with the
+    jobs that are left, without crawling the courses again, provided the
+    plan was complete. Once all the jobs have been tried the plan is
+    dropped, so the next run crawls the courses again (and retries what
+    failed); the jobs that failed are listed in the failed file."""
+
+    STATE_FILE = ".coursera-dl-jobs.json"
+    DONE_FILE = ".coursera-dl-jobs.done"
+    FAILED_FILE = ".coursera-dl-jobs.failed"
+
+    def __init__(self,downloader,dest_dir="."):
+        self.downloader = downloader
+        self.dest_dir = dest_dir
+        self.state_file = os.path.join(dest_dir,self.STATE_FILE)
+        self.done_file = os.path.join(dest_dir,self.DONE_FILE)
+        self.failed_file = os.path.join(dest_dir,self.FAILED_FILE)
+
+    def load(self,course_names):
+        """Return the saved jobs of an interrupted run for the same courses,
+        the set of ids of those that were finished and whether all the jobs
+        had been planned, or (None,None,False)"""
+        # the state file has a line with the courses, one line per job and a
+        # last line once all the jobs are in
+        lines = []
+        try:
+            with open(self.state_file) as f:
+                for l in f:
+                    lines.append(json.loads(l))
+        except IOError:
+            pass
+        except ValueError:
+            # the last line was being written
+            pass
+
+        if not lines or lines[0].get('courses') != list(course_names):
+            return None,None,False
+
+        complete = bool(lines[-1].get('complete'))
+        if complete:
+            lines.pop()
+
+        done = set()
+        if os.path.exists(self.done_file):
+            with open(self.done_file) as f:
+                done = set(int(l) for l in f if l.strip())
+
+        return [Job.from_dict(d) for d in lines[1:]],done,complete
+
+    def save(self,course_names,jobs,finished=(),planned=None):
+        """Return a generator of the jobs that writes them to the state file
+        as they come (and appends them to the planned list, if given). The
+        jobs that are finished already, given by (id,url), are written but
+        not generated."""
+        with open(self.done_file,'w') as f:
+            for i,_ in sorted(finished):
+                f.write("%d\n" % i)
+
+        f = open(self.state_file,'w')
+        f.write(json.dumps({'courses':list(course_names)}) + "\n")
+
+        def write():
+            with f:
+                for job in jobs:
+                    f.write(json.dumps(job.to_dict()) + "\n")
+                    f.flush()
+                    if planned is not None:
+                        planned.append(job)
+                    if (job.id,job.url) not in finished:
+                        yield job
+                f.write(json.dumps({'complete':True}) + "\n")
+        return write()
+
+    def clear(self):
+        for fn in (self.state_file,self.done_file,self.failed_file):
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def iter_plan(self,course_names):
+        """Plan all the courses, generates their jobs taking turns between
+        the courses, as they are planned"""
+        courses = [self.downloader.plan_course(cname,self.dest_dir,stream=True) for cname in course_names]
+
+        i = 0
+        while courses:
+            for jobs in list(courses):
+                try:
+                    job = next(jobs)
+                except StopIteration:
+                    courses.remove(jobs)
+                    continue
+                job.id = i
+                i += 1
+                yield job
+
+    def plan(self,course_names):
+        """Plan all the courses, returns the list of jobs"""
+        return list(self.iter_plan(course_names))
+
+    def run(self,course_names,jobs=None):
+        """Download the courses (or only the given jobs of them, which must
+        have been planned), returns the list of jobs of the run"""
+        if jobs is not None:
+            todo = self.save(course_names,jobs)
+        else:
+            jobs,done,complete = self.load(course_names)
+            if jobs is None:
+                jobs = []
+                todo = self.save(course_names,self.iter_plan(course_names),planned=jobs)
+            elif not complete:
+                # interrupted while still planning: plan again, skipping the
+                # jobs that are done (the same plan gives them the same ids)
+                print "* Resuming the interrupted run, %d jobs done" % len(done)
+                finished = set((j.id,j.url) for j in jobs if j.id in done)
+                jobs = []
+                todo = self.save(course_names,self.iter_plan(course_names),finished,jobs)
+            else:
+                print "* Resuming the interrupted run, %d of %d jobs left" % (len(jobs) - len(done),len(jobs))
+
+                # the session still needs to be set up for the courses that are left
+                for cname in course_names:
+                    if any(j.course == cname and j.id not in done for j in jobs):
+                        self.downloader.login(cname)
+
+                # interleave the courses
+                order = dict((c,i) for i,c in enumerate(course_names))
+                todo = [j for j in jobs if j.id not in done]
+                todo.sort(key=lambda j: (j.priority,order[j.course]))
+
+        output = JobOutput(len(course_names) > 1)
+
+        d = self.downloader
+        failed = []
+        try:
+            with open(self.done_file,'a') as log:
+                # (the jobs are logged as done as soon as they are)
+                for i,job,out in imap_unordered(lambda (i,job): (i,job,d.download_job(job)),enumerate(todo),d.workers):
+                    output.add(i,job,out)
+
+                    if job.ok:
+                        log.write("%d\n" % job.id)
+                        log.flush()
+                    else:
+                        failed.append(job)
+        finally:
+            output.flush()
+            d.close_manifests()
+
+        # every job has been tried, the next run plans afresh
+        self.clear()
+        if failed:
+            write_file(self.failed_file,"".join(json.dumps(j.to_dict()) + "\n" for j in failed))
+            print "* %d downloads failed (see %s), run again to retry them" % (len(failed),self.failed_file)
+
+        return jobs
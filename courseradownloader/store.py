@@ -0,0 +1,125 @@
+"""
+Content addressed store of the downloaded files, shared by all courses, so a
+file that appears in several courses (or offerings of the same course) is
+downloaded and kept on disk only once.
+"""
+import os
+import time
+import errno
+import shutil
+import sqlite3
+import threading
+from writer import replace
+
+class ObjectStore(object):
+    """Directory holding one copy of every file, named by its sha1 checksum
+    (objects/ab/cdef...), which is hardlinked into the course directories.
+    The ETag and size of the downloads are recorded with their checksum, so a
+    file the store already has is recognised from the response headers."""
+
+    INDEX = "index.sqlite"
+
+    def __init__(self,root):
+        self.root = root
+
+        # the connection is shared by the download threads. It is only opened
+        # when needed, and the store only created when a file is added to it,
+        # so looking files up (as --plan does) writes nothing.
+        self.lock = threading.Lock()
+        self.db = None
+
+    def index(self,create=False):
+        """Return the connection to the index (call with the lock held), or
+        None if the store has none yet and create is False"""
+        if self.db is None:
+            path = os.path.join(self.root,self.INDEX)
+            if not create and not os.path.exists(path):
+                return None
+            if not os.path.exists(os.path.join(self.root,"objects")):
+                os.makedirs(os.path.join(self.root,"objects"))
+            self.db = sqlite3.connect(path,check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS etags (
+                                etag TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                sha1 TEXT NOT NULL,
+                                added REAL,
+                                PRIMARY KEY (etag,size))""")
+            self.db.commit()
+        return self.db
+
+    def object_path(self,sha1):
+        return os.path.join(self.root,"objects",sha1[:2],sha1[2:])
+
+    def has(self,sha1):
+        return bool(sha1) and os.path.isfile(self.object_path(sha1))
+
+    def lookup(self,etag,size):
+        """Return the checksum of the stored file that was downloaded with the
+        given ETag and size, or None"""
+        if not etag or etag.startswith('W/') or size < 0:
+            # weak ETags do not identify the bytes
+            return None
+
+        with self.lock:
+            db = self.index()
+            row = db.execute("SELECT sha1 FROM etags WHERE etag = ? AND size = ?",(etag,size)).fetchone() if db else None
+        return row[0] if row and self.has(row[0]) else None
+
+    def add(self,filepath,sha1,size,etag=None):
+        """Put the downloaded file in the store. If the store has it already,
+        the file is replaced by a link to the stored copy."""
+        obj = self.object_path(sha1)
+        if not os.path.exists(obj):
+            if not os.path.exists(os.path.dirname(obj)):
+                try:
+                    os.makedirs(os.path.dirname(obj))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            try:
+                place(filepath,obj)
+            except OSError as e:
+                # stored by another thread meanwhile
+                if e.errno != errno.EEXIST:
+                    raise
+                self.link(sha1,filepath)
+        elif not samefile(obj,filepath):
+            self.link(sha1,filepath)
+
+        if etag and not etag.startswith('W/'):
+            with self.lock:
+                db = self.index(create=True)
+                db.execute("INSERT OR REPLACE INTO etags VALUES (?,?,?,?)",(etag,size,sha1,time.time()))
+                db.commit()
+
+    def link(self,sha1,filepath):
+        """Put (a link to) the stored file with the given checksum at filepath"""
+        tmp = filepath + ".link"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        place(self.object_path(sha1),tmp)
+        replace(tmp,filepath)
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+def place(src,dst):
+    """Hardlink src to dst, or copy it where that is not possible (another
+    file system, or no hardlinks on the platform)"""
+    try:
+        os.link(src,dst)
+    except AttributeError:
+        shutil.copy2(src,dst)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise
+        shutil.copy2(src,dst)
+
+def samefile(a,b):
+    try:
+        return os.path.samefile(a,b)
+    except (OSError,AttributeError):
+        return False
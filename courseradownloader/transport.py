@@ -0,0 +1,217 @@
+"""
+Persistent (keep-alive) http connections, shared by the browsers of all the
+threads, so the many small requests of a course (pages, iframes, headers)
+do not each pay for a new TCP (and TLS) connection.
+"""
+import socket
+import httplib
+import threading
+from mechanize import HTTPHandler, HTTPSHandler
+
+class ConnectionPool(object):
+    """The idle connections, by host. A connection is taken out of the pool
+    for a request and put back once its response has been read completely
+    (a response that is not read to the end closes its connection). At most
+    max_idle connections are kept per host."""
+
+    DEFAULT_MAX_IDLE = 8
+
+    def __init__(self,max_idle=DEFAULT_MAX_IDLE,on_connect=None):
+        """on_connect(reused) is called on the requesting thread whenever a
+        connection is taken for a request"""
+        self.max_idle = max_idle
+        self.on_connect = on_connect
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+        # idle connections found closed by the server
+        self.stale = 0
+
+    def get(self,key,connect):
+        """Return an idle connection to the host (key), or a new one made by
+        connect(), and whether it was reused"""
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                self.reused += 1
+                conn,reused = conns.pop(),True
+            else:
+                self.opened += 1
+                conn,reused = None,False
+
+        if conn is None:
+            conn = connect()
+        if self.on_connect:
+            self.on_connect(reused)
+        return conn,reused
+
+    def put(self,key,conn):
+        with self.lock:
+            conns = self.idle.setdefault(key,[])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def reconnect(self,connect):
+        """Return a new connection made by connect() in place of an idle one
+        that turned out to be closed"""
+        with self.lock:
+            self.stale += 1
+            self.opened += 1
+        conn = connect()
+        if self.on_connect:
+            self.on_connect(False)
+        return conn
+
+    def stats(self):
+        with self.lock:
+            return {'opened':self.opened,'reused':self.reused,'stale':self.stale}
+
+    def close(self):
+        with self.lock:
+            idle,self.idle = self.idle,{}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def connection_class(self,conn_class):
+        """Return a connection factory for the mechanize http handlers (which
+        make a new connection for every request) that takes the connection
+        from the pool instead"""
+        def factory(host,timeout=socket._GLOBAL_DEFAULT_TIMEOUT,**kwargs):
+            return PooledConnection(self,conn_class,host,timeout,kwargs)
+        return factory
+
+class PooledConnection(object):
+    """The part of the httplib.HTTPConnection api the mechanize handlers use,
+    for a single request over a pooled connection. A request on a reused
+    connection that the server has closed meanwhile is sent again once, on a
+    new connection."""
+
+    def __init__(self,pool,conn_class,host,timeout,kwargs):
+        self.pool = pool
+        self.conn_class = conn_class
+        self.host = host
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.debuglevel = 0
+        self.tunnel = None
+        self.args = None
+
+    def set_debuglevel(self,level):
+        self.debuglevel = level
+
+    def set_tunnel(self,host,port=None,headers=None):
+        self.tunnel = (host,port,headers)
+
+    def key(self):
+        return (self.conn_class,self.host,self.tunnel and self.tunnel[:2])
+
+    def connect(self):
+        conn = self.conn_class(self.host,timeout=self.timeout,**self.kwargs)
+        if self.tunnel:
+            conn.set_tunnel(*self.tunnel)
+        return conn
+
+    def request(self,method,url,body=None,headers={}):
+        # the handlers ask for the connection to be closed after the response
+        headers = dict((k,v) for k,v in headers.items() if k.lower() != 'connection')
+        self.args = (method,url,body,headers)
+
+    def getresponse(self):
+        conn,reused = self.pool.get(self.key(),self.connect)
+        conn.set_debuglevel(self.debuglevel)
+        if conn.sock is not None and isinstance(self.timeout,(int,float)):
+            conn.sock.settimeout(self.timeout)
+
+        while True:
+            try:
+                conn.request(*self.args)
+                return PooledResponse(conn.getresponse(),self.pool,self.key(),conn)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error,httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+
+                # closed by the server while idle
+                conn,reused = self.pool.reconnect(self.connect),False
+
+    def close(self):
+        pass
+
+class PooledResponse(object):
+    """An httplib response that gives its connection back to the pool once
+    it has been read to the end"""
+
+    def __init__(self,response,pool,key,conn):
+        self.response = response
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.released = False
+
+    def __getattr__(self,name):
+        # (msg, status, reason, getheader, ...)
+        return getattr(self.response,name)
+
+    def read(self,amt=None):
+        data = self.response.read() if amt is None else self.response.read(amt)
+        if self.response.isclosed():
+            self.release(True)
+        return data
+
+    def close(self):
+        r = self.response
+        # (a HEAD response or one without a body has nothing to read)
+        self.release(r.isclosed() or r.length == 0)
+        r.close()
+
+    def release(self,complete):
+        if self.released:
+            return
+        self.released = True
+
+        if complete and not self.response.will_close:
+            self.pool.put(self.key,self.conn)
+        else:
+            self.conn.close()
+
+class KeepAliveHandler(HTTPHandler):
+    """mechanize http handler making its requests over the connections of
+    the pool"""
+
+    # (ahead of the default handler, which is still there for the browser)
+    handler_order = HTTPHandler.handler_order - 10
+
+    def __init__(self,pool):
+        HTTPHandler.__init__(self)
+        self.pool = pool
+        self.connection_class = pool.connection_class(httplib.HTTPConnection)
+
+    def http_open(self,req):
+        return self.do_open(self.connection_class,req)
+
+    def http_request(self,req):
+        # (the default handler, still in the browser, prepares the requests)
+        return req
+
+class KeepAliveHTTPSHandler(HTTPSHandler):
+    """The https version of KeepAliveHandler"""
+
+    handler_order = HTTPSHandler.handler_order - 10
+
+    def __init__(self,pool):
+        HTTPSHandler.__init__(self)
+        self.pool = pool
+        self.connection_class = pool.connection_class(httplib.HTTPSConnection)
+
+    def https_open(self,req):
+        return self.do_open(self.connection_class,req)
+
+    def https_request(self,req):
+        return req
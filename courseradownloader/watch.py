@@ -0,0 +1,61 @@
+"""
+Watch mode: keeps the courses in sync from a single long running process,
+downloading what was added to them since the last look.
+"""
+import time
+from scheduler import Scheduler
+
+class Watcher(object):
+    """Downloads the courses once, then every interval seconds crawls them
+    again (with the same session) and downloads only the lectures, quizzes,
+    assignments and pages that were not there before. Thanks to the crawl
+    cache an unchanged lecture index costs a single conditional request."""
+
+    def __init__(self,downloader,dest_dir=".",interval=3600):
+        self.downloader = downloader
+        self.scheduler = Scheduler(downloader,dest_dir)
+        self.interval = interval
+
+        # the urls of everything found so far
+        self.seen = set()
+
+    def new_jobs(self,course_names):
+        """Crawl the courses again and return the jobs of what is new"""
+        # check whether the session is still valid (once per round)
+        self.downloader.sessions.clear()
+
+        jobs = [j for j in self.scheduler.plan(course_names) if j.url and j.url not in self.seen]
+        for i,job in enumerate(jobs):
+            job.id = i
+        return jobs
+
+    def run(self,course_names,rounds=None):
+        """Watch the courses (for the given number of rounds, or forever)"""
+        d = self.downloader
+        n = 0
+        while True:
+            try:
+                if n == 0:
+                    jobs = self.scheduler.run(course_names)
+                else:
+                    jobs = self.new_jobs(course_names)
+                    if jobs:
+                        print "* %d new items" % len(jobs)
+                        self.scheduler.run(course_names,jobs)
+                    else:
+                        print "* Nothing new"
+
+                self.seen.update(j.url for j in jobs if j.url and j.ok is not False)
+            except Exception as e:
+                # (e.g. the network is down, try again next time)
+                print "* Checking the courses failed: %s" % e
+            finally:
+                d.save_cookies()
+                d.controller.print_failures()
+
+            n += 1
+            if rounds is not None and n >= rounds:
+                break
+
+            print "* Next check at " + time.strftime("%H:%M:%S",time.localtime(time.time() + self.interval))
+            time.sleep(self.interval)
@@ -0,0 +1,188 @@
+"""
+Writing of downloads (and the state files) so that a file only ever appears
+under its own name once it is complete: the data goes to a temporary file
+next to it, which is synced and renamed when done.
+"""
+import os
+import json
+import uuid
+import shutil
+import threading
+import ctypes
+import ctypes.util
+
+# fallocate(2), to reserve the space of a download up front so big files are
+# not fragmented (linux only, elsewhere the space is not reserved)
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno=True)
+    _fallocate = _libc.fallocate64
+    _fallocate.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_int64,ctypes.c_int64]
+except (OSError,AttributeError):
+    _fallocate = None
+
+# allocate without changing the size of the file, so the size of a partial
+# download still says how much of it is there
+FALLOC_FL_KEEP_SIZE = 1
+
+def preallocate(f,offset,length):
+    """Reserve length bytes of disk space from offset in the (open) file,
+    if the platform supports it. Returns whether it did."""
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(f.fileno(),FALLOC_FL_KEEP_SIZE,offset,length) == 0
+
+def replace(src,dst):
+    """Rename src to dst, replacing dst (atomically, except on windows)"""
+    if os.name == 'nt' and os.path.exists(dst):
+        # no atomic replace on windows
+        os.remove(dst)
+    os.rename(src,dst)
+
+def detach(src,dst):
+    """Move src to dst to be written to: renamed, or copied if src has other
+    hard links (e.g. from the store), which must not change with it"""
+    if os.stat(src).st_nlink > 1:
+        shutil.copyfile(src,dst)
+        os.remove(src)
+    else:
+        replace(src,dst)
+
+def sync(path):
+    """Flush the contents of the file to disk"""
+    fd = os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(filename,data):
+    """Write the file through a temporary one, so readers (or the next run
+    after a crash) never see it half written"""
+    # (of its own, the same file may be written by other threads or processes)
+    tmp = "%s.%s.tmp" % (filename,uuid.uuid4().hex[:8])
+    with open(tmp,'wb') as f:
+        f.write(data)
+    replace(tmp,filename)
+
+class PartFile(object):
+    """A download in progress: written to filepath + SUFFIX, starting at
+    offset (the part that is there already is kept), and moved to filepath
+    by commit once all of its size bytes (if known) are there. When
+    interrupted the part file is kept, so the download can be resumed."""
+
+    SUFFIX = ".part"
+
+    def __init__(self,filepath,size=-1,offset=0):
+        self.filepath = filepath
+        self.path = filepath + self.SUFFIX
+        self.size = size
+
+        self.f = open(self.path,'r+b' if offset else 'wb')
+        self.f.seek(offset)
+        self.f.truncate()
+        if size > offset:
+            preallocate(self.f,offset,size - offset)
+
+    def write(self,data):
+        self.f.write(data)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+    def commit(self):
+        """Check the size, sync and move the file into place"""
+        self.f.flush()
+        written = self.f.tell()
+        if self.size >= 0 and written < self.size:
+            self.close()
+            raise IOError("retrieval incomplete: got only %i out of %i bytes" % (written,self.size))
+
+        os.fsync(self.f.fileno())
+        self.close()
+        replace(self.path,self.filepath)
+
+class SegmentedPart(object):
+    """A download in segments in progress: the segments are written at their
+    offsets in the part file (see PartFile), preallocated to the full size,
+    and the segments and which of them are complete are recorded next to it
+    (filepath + PartFile.SUFFIX + SUFFIX). An interrupted download of the
+    same file (size and ETag) only gets its missing segments again."""
+
+    SUFFIX = ".segments"
+
+    def __init__(self,filepath,size,etag=None):
+        self.filepath = filepath
+        self.path = filepath + PartFile.SUFFIX
+        self.state_path = self.path + self.SUFFIX
+        self.size = size
+        self.etag = etag
+        self.ranges = []
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Take over the segments of an interrupted download, returns False
+        if there is none (of this version of the file)"""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError,ValueError):
+            return False
+
+        if (state.get('size') != self.size or state.get('etag') != self.etag or
+                not os.path.exists(self.path) or os.path.getsize(self.path) != self.size):
+            return False
+
+        self.ranges = [tuple(r) for r in state['ranges']]
+        self.done = set(state['done'])
+        return True
+
+    def create(self,n):
+        """Start the download afresh, in n segments of equal size (the last
+        one takes the remainder)"""
+        seglen = self.size // n
+        self.ranges = [(i*seglen,(i+1)*seglen-1 if i < n-1 else self.size-1) for i in range(n)]
+        self.done = set()
+
+        with open(self.path,'wb') as f:
+            preallocate(f,0,self.size)
+            f.truncate(self.size)
+        self.save()
+
+    def missing(self):
+        """Return the (index,(start,end)) of the segments still to get"""
+        return [(i,r) for i,r in enumerate(self.ranges) if i not in self.done]
+
+    def finished(self,i):
+        """Record the segment as complete, once its data is on disk (so a
+        crash cannot leave a segment recorded that is not there)"""
+        sync(self.path)
+        with self.lock:
+            self.done.add(i)
+            self.save()
+
+    def save(self):
+        write_file(self.state_path,json.dumps({'size':self.size,'etag':self.etag,
+                                               'ranges':self.ranges,'done':sorted(self.done)}))
+
+    def commit(self):
+        """Check that all the segments are there and move the file into place
+        (each segment was synced when it was recorded)"""
+        missing = self.missing()
+        if missing:
+            raise IOError("segmented download is missing %d of %d segments" % (len(missing),len(self.ranges)))
+
+        replace(self.path,self.filepath)
+        self.remove(self.state_path)
+
+    def discard(self):
+        self.remove(self.path)
+        self.remove(self.state_path)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass